@@ -27,7 +27,8 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from math import ceil
-from numpy import arange, amax, stack, amin, float32, uint8, zeros, sqrt, empty, int32, uint16
+from numpy import arange, amax, stack, amin, float32, uint8, zeros, sqrt, empty, int32, uint16, \
+    ascontiguousarray, asarray, int64, prod
 from scipy import ndimage
 try:
     from skimage.registration import phase_cross_correlation
@@ -90,8 +91,10 @@ class AlignmentPoints(object):
         # Initialize the number of frames to be stacked at each AP.
         self.stack_size = None
 
-        self.dev_table = empty((2 * self.configuration.alignment_points_search_width + 1,
-                               2 * self.configuration.alignment_points_search_width + 1), dtype=float32)
+        # Array with the drizzled patch bounds of all APs, and the array which holds the stacking
+        # buffers of all APs. They are set when the stacking buffers are initialized.
+        self.patch_bounds_drizzled = None
+        self.stacking_buffers_slab = None
 
     @staticmethod
     def ap_locations(num_pixels, min_boundary_distance, step_size, even):
@@ -512,11 +515,54 @@ class AlignmentPoints(object):
             # The reference box with the full resolution is used in the second phase.
             alignment_point['reference_box_second_phase'] = window_second_phase
 
-            # In the first phase a box with half the resolution is constructed.
-            alignment_point['reference_box_first_phase'] =  window_second_phase[::2, ::2]
+            # In the first phase a box with half the resolution is constructed. Store it as a
+            # contiguous array, so that it need not be copied in every correlation.
+            alignment_point['reference_box_first_phase'] = \
+                ascontiguousarray(window_second_phase[::2, ::2])
+
+    def initialize_ap_stacking_buffers(self, drizzle_factor, color):
+        """
+        Allocate the stacking buffers of all alignment points and compute their drizzled patch
+        index bounds. The bounds are also collected in an array with one entry per AP, for use in
+        vectorized and compiled code.
+
+        :param drizzle_factor: Drizzle factor (integer: 1, 2 or 3)
+        :param color: True, if stacking is to be done for color frames. False for monochrome case.
+        :return: -
+        """
+
+        # All stacking buffers are views into a single array (slab). Each buffer starts at a
+        # multiple of 64 bytes (16 float32 values), so that rows can be processed with aligned SIMD
+        # instructions, and buffers of different APs do not share cache lines.
+        alignment = 16
+        channels = 3 if color else 1
+        offsets = []
+        slab_size = 0
+        for alignment_point in self.alignment_points:
+            offsets.append(slab_size)
+            buffer_size = (alignment_point['patch_y_high'] - alignment_point['patch_y_low']) * \
+                          (alignment_point['patch_x_high'] - alignment_point['patch_x_low']) * \
+                          drizzle_factor ** 2 * channels
+            slab_size += ceil(buffer_size / alignment) * alignment
+
+        # Over-allocate by one alignment unit, and shift the start to a 64 byte boundary.
+        slab = zeros(slab_size + alignment, dtype=float32)
+        slab_start = (-slab.ctypes.data % 64) // slab.itemsize
+        self.stacking_buffers_slab = slab[slab_start:slab_start + slab_size]
+
+        for alignment_point, offset in zip(self.alignment_points, offsets):
+            self.initialize_ap_stacking_buffer(alignment_point, drizzle_factor, color,
+                                               slab=self.stacking_buffers_slab[offset:])
+
+        # The four patch bounds of an AP are always used together. Therefore, they are stored in
+        # one row (y_low, y_high, x_low, x_high) per AP.
+        self.patch_bounds_drizzled = asarray(
+            [[alignment_point['patch_y_low_drizzled'], alignment_point['patch_y_high_drizzled'],
+              alignment_point['patch_x_low_drizzled'], alignment_point['patch_x_high_drizzled']]
+             for alignment_point in self.alignment_points], dtype=int64).reshape(-1, 4)
 
     @staticmethod
-    def initialize_ap_stacking_buffer(alignment_point, drizzle_factor, color):
+    def initialize_ap_stacking_buffer(alignment_point, drizzle_factor, color, slab=None):
         """
         In the stacking initialization, for each AP a stacking buffer has to be allocated. At the
         same time, drizzled patch index bounds are computed.
@@ -524,6 +570,8 @@ class AlignmentPoints(object):
         :param alignment_point: Alignment_point object
         :param drizzle_factor: Drizzle factor (integer: 1, 2 or 3)
         :param color: True, if stacking is to be done for color frames. False for monochrome case.
+        :param slab: Optional zero-initialized 1D float32 array. If given, the stacking buffer is a
+                     view into its leading part. Otherwise, a new array is allocated.
         :return: -
         """
 
@@ -537,16 +585,19 @@ class AlignmentPoints(object):
 
         # Allocate space for the stacking buffer.
         if color:
-            alignment_point['stacking_buffer'] = zeros(
-                [alignment_point['patch_y_high_drizzled'] - alignment_point['patch_y_low_drizzled'],
-                 alignment_point['patch_x_high_drizzled'] - alignment_point['patch_x_low_drizzled'],
-                 3],
-                dtype=float32)
+            shape = (alignment_point['patch_y_high_drizzled'] -
+                     alignment_point['patch_y_low_drizzled'],
+                     alignment_point['patch_x_high_drizzled'] -
+                     alignment_point['patch_x_low_drizzled'], 3)
+        else:
+            shape = (alignment_point['patch_y_high_drizzled'] -
+                     alignment_point['patch_y_low_drizzled'],
+                     alignment_point['patch_x_high_drizzled'] -
+                     alignment_point['patch_x_low_drizzled'])
+        if slab is None:
+            alignment_point['stacking_buffer'] = zeros(shape, dtype=float32)
         else:
-            alignment_point['stacking_buffer'] = zeros(
-                [alignment_point['patch_y_high_drizzled'] - alignment_point['patch_y_low_drizzled'],
-                 alignment_point['patch_x_high_drizzled'] - alignment_point[
-                     'patch_x_low_drizzled']], dtype=float32)
+            alignment_point['stacking_buffer'] = slab[:prod(shape)].reshape(shape)
 
     def find_alignment_points(self, y_low, y_high, x_low, x_high):
         """
@@ -832,11 +883,16 @@ class AlignmentPoints(object):
 
             # Use the steepest descent search method.
             elif self.configuration.alignment_points_method == 'SteepestDescent':
+                # The search overwrites its scratch table. This method is called for several APs
+                # concurrently (see "StackFrames.stack_frames"), so each call needs its own table.
+                dev_table = empty((2 * self.configuration.alignment_points_search_width + 1,
+                                   2 * self.configuration.alignment_points_search_width + 1),
+                                  dtype=float32)
                 shift_pixel, dev_r = Miscellaneous.search_local_match_gradient(
                     alignment_point['reference_box'],
                     frame_mono_blurred, y_low + dy, y_high + dy, x_low + dx, x_high + dx,
                     self.configuration.alignment_points_search_width,
-                    self.configuration.alignment_points_sampling_stride, self.dev_table)
+                    self.configuration.alignment_points_sampling_stride, dev_table)
                 success = len(dev_r)<=2 or shift_pixel!=[0, 0]
             else:
                 raise NotSupportedError("The point shift computation method " +
@@ -66,6 +66,7 @@ class ConfigurationParameters(object):
         self.frames_normalization = None
         self.frames_normalization_threshold = None
         self.frames_add_selection_dialog = None
+        self.frames_ranks_cache_size = None
         self.align_frames_fast_changing_object = None
         self.align_frames_mode = None
         self.align_frames_automation = None
@@ -109,6 +110,7 @@ class ConfigurationParameters(object):
         self.frames_normalization = True
         self.frames_normalization_threshold = 15
         self.frames_add_selection_dialog = False
+        self.frames_ranks_cache_size = 20
         self.align_frames_fast_changing_object = True
         self.align_frames_mode = 'Surface'
         self.align_frames_automation = True
@@ -173,6 +175,7 @@ class ConfigurationParameters(object):
         self.frames_normalization = configuration_object.frames_normalization
         self.frames_normalization_threshold = configuration_object.frames_normalization_threshold
         self.frames_add_selection_dialog = configuration_object.frames_add_selection_dialog
+        self.frames_ranks_cache_size = configuration_object.frames_ranks_cache_size
         self.align_frames_fast_changing_object = \
             configuration_object.align_frames_fast_changing_object
         self.align_frames_mode = configuration_object.align_frames_mode
@@ -260,6 +263,9 @@ class Configuration(object):
         # Initialize the ConfigParser object for parameters which the user can change.
         self.config_parser_object = ConfigParser()
 
+        # Frame ranks are not cached unless a cache directory is set in "initialize_configuration".
+        self.rank_frames_cache_dir = None
+
         # Create and initialize the central data object for postprocessing.
         self.postproc_data_object = PostprocDataObject(self.postproc_suffix)
 
@@ -281,9 +287,15 @@ class Configuration(object):
             self.config_filename = join(self.home, ".PlanetarySystemStacker.ini")
             self.protocol_filename = join(self.home, "PlanetarySystemStacker.log")
 
+            # Frame ranks are cached in a directory next to the config file, so that they need not
+            # be computed again if the same input is processed in a later run. The number of cached
+            # rank files is limited by the parameter "frames_ranks_cache_size".
+            self.rank_frames_cache_dir = join(self.home, ".PlanetarySystemStacker_cache")
+
             # Determine if there is a configuration file from a previous run.
             self.config_file_exists = isfile(self.config_filename)
         else:
+            self.rank_frames_cache_dir = None
             self.config_file_exists = False
 
         # If an existing config file is found, read it in. Set flag to indicate if parameters were
@@ -371,6 +383,7 @@ class Configuration(object):
             configuration_parameters.frames_normalization_threshold
         self.frames_add_selection_dialog = \
             configuration_parameters.frames_add_selection_dialog
+        self.frames_ranks_cache_size = configuration_parameters.frames_ranks_cache_size
         self.align_frames_fast_changing_object = \
             configuration_parameters.align_frames_fast_changing_object
         self.align_frames_mode = configuration_parameters.align_frames_mode
@@ -443,6 +456,7 @@ class Configuration(object):
         configuration_parameters.frames_normalization = self.frames_normalization
         configuration_parameters.frames_normalization_threshold = self.frames_normalization_threshold
         configuration_parameters.frames_add_selection_dialog = self.frames_add_selection_dialog
+        configuration_parameters.frames_ranks_cache_size = self.frames_ranks_cache_size
 
         configuration_parameters.align_frames_fast_changing_object = \
             self.align_frames_fast_changing_object
@@ -541,6 +555,8 @@ class Configuration(object):
             'normalization threshold', default_conf_obj.frames_normalization_threshold)
         self.frames_add_selection_dialog = get_from_conf(conf, 'Frames',
             'add selection dialog', default_conf_obj.frames_add_selection_dialog)
+        self.frames_ranks_cache_size = get_from_conf(conf, 'Frames', 'ranks cache size',
+            default_conf_obj.frames_ranks_cache_size)
 
         self.align_frames_fast_changing_object = get_from_conf(conf, 'Align frames',
             'fast changing object', default_conf_obj.align_frames_fast_changing_object)
@@ -636,6 +652,7 @@ class Configuration(object):
         self.set_parameter('Frames', 'normalization threshold',
                            str(self.frames_normalization_threshold))
         self.set_parameter('Frames', 'add selection dialog', str(self.frames_add_selection_dialog))
+        self.set_parameter('Frames', 'ranks cache size', str(self.frames_ranks_cache_size))
 
         self.config_parser_object.add_section('Align frames')
         self.set_parameter('Align frames', 'fast changing object',
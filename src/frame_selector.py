@@ -581,8 +581,8 @@ class FramePlayer(QtCore.QObject):
                 if not self.frame_selector_widget.frame_selector.image_loading_busy:
                     self.frame_selector_widget.frame_index += 1
                     self.frame_selector_widget.quality_index = \
-                        self.frame_selector_widget.quality_sorted_indices.index(
-                            self.frame_selector_widget.frame_index)
+                        self.frame_selector_widget.rank_indices[
+                            self.frame_selector_widget.frame_index]
                     self.set_slider_value.emit(self.frame_selector_widget.frame_index + 1)
                     self.set_photo_signal.emit(self.frame_selector_widget.frame_index)
 
@@ -674,7 +674,7 @@ class FrameViewerWidget(QtWidgets.QFrame, Ui_frame_viewer):
             self.matplotlib_widget.plot_dot(self.quality_index)
         else:
             self.frame_index = index
-            self.quality_index = self.rank_frames.quality_sorted_indices.index(self.frame_index)
+            self.quality_index = self.rank_frames.rank_indices[self.frame_index]
             self.matplotlib_widget.plot_dot(self.frame_index)
 
         # Block signals temporarily to avoid feedback loops. Then update widget contents.
@@ -749,7 +749,7 @@ class FrameViewerWidget(QtWidgets.QFrame, Ui_frame_viewer):
         """
 
         self.frame_index = self.spinBox_chronological.value() - 1
-        self.quality_index = self.rank_frames.quality_sorted_indices.index(self.frame_index)
+        self.quality_index = self.rank_frames.rank_indices[self.frame_index]
         self.slider_frames.blockSignals(True)
         self.spinBox_quality.blockSignals(True)
         self.spinBox_quality.setValue(self.quality_index + 1)
@@ -943,8 +943,8 @@ class FramePlayer(QtCore.QObject):
                 if not self.frame_viewer_widget.frame_viewer.image_loading_busy:
                     self.frame_viewer_widget.frame_index += 1
                     self.frame_viewer_widget.quality_index = \
-                        self.frame_viewer_widget.rank_frames.quality_sorted_indices.index(
-                        self.frame_viewer_widget.frame_index)
+                        self.frame_viewer_widget.rank_frames.rank_indices[
+                        self.frame_viewer_widget.frame_index]
                     self.set_slider_value.emit(self.frame_viewer_widget.frame_index + 1)
                     self.set_photo_signal.emit(self.frame_viewer_widget.frame_index)
                 sleep(self.delay_between_frames)
@@ -40,7 +40,7 @@ from numpy import max as np_max
 from numpy import min as np_min
 from numpy import sum as np_sum
 from numpy import uint8, uint16, int32, float32, clip, zeros, float64, where, average, moveaxis, \
-    unravel_index, ndarray
+    unravel_index, ndarray, argmin, asarray, int64
 
 import ser_parser
 from configuration import Configuration
@@ -1189,7 +1189,9 @@ class Frames(object):
         self.frames_monochrome_blurred = [None] *self.number_original
         self.frames_monochrome_blurred_laplacian = [None] *self.number_original
         if self.configuration.frames_normalization:
-            self.frames_average_brightness = [None] *self.number_original
+            # Brightness values are stored lazily as they are computed. Zero means "not yet
+            # computed" (computed values always are positive).
+            self.frames_average_brightness = zeros(self.number_original, dtype=float64)
         else:
             self.frames_average_brightness = None
         self.first_monochrome_index = None
@@ -1596,6 +1598,32 @@ class Frames(object):
             raise InternalError("Accessing average frame brightness before computing it, frame: " +
                                 str(index_original))
 
+    def average_brightness_original(self):
+        """
+        Look up the average brightness values of all original frames (i.e. ignoring index
+        translation).
+
+        :return: Array with the average brightness of all original frames
+        """
+
+        if not self.frames_average_brightness.all():
+            raise InternalError("Accessing average frame brightness before computing it, frame: " +
+                                str(int(argmin(self.frames_average_brightness))))
+        return self.frames_average_brightness
+
+    def average_brightness_all(self):
+        """
+        Look up the average brightness values of all frames. If index translation is active, the
+        values are returned for the reduced set of frames, in translated index order.
+
+        :return: Array with the average brightness of all frames
+        """
+
+        if self.index_translation_active:
+            return self.average_brightness_original()[asarray(self.index_translation,
+                                                              dtype=int64)]
+        return self.average_brightness_original()
+
     def set_index_translation(self):
         """
         Set the index translation table. The list "self.index_included" for every original frame
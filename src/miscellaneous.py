@@ -27,7 +27,8 @@ from time import time, sleep
 
 from cv2 import CV_32F, Laplacian, VideoWriter_fourcc, VideoWriter, FONT_HERSHEY_SIMPLEX, LINE_AA, \
     putText, GaussianBlur, cvtColor, COLOR_BGR2HSV, COLOR_HSV2BGR, BORDER_DEFAULT, meanStdDev,\
-    resize, matchTemplate, minMaxLoc, TM_CCORR_NORMED, bilateralFilter, INTER_CUBIC
+    resize, matchTemplate, minMaxLoc, TM_CCORR_NORMED, bilateralFilter, INTER_CUBIC, Sobel, \
+    magnitude, sumElems, UMat, BORDER_REFLECT, ocl
 from numpy import abs as np_abs
 from numpy import diff, average, hypot, sqrt, unravel_index, argmax, zeros, arange, array, matmul, \
     empty, argmin, stack, sin, uint8, float32, uint16, full
@@ -35,9 +36,12 @@ from math import exp
 from numpy import min as np_min
 from numpy.fft import fft2, ifft2
 from numpy.linalg import solve
-from scipy.ndimage import sobel
 
 from exceptions import DivideByZeroError, ArgumentError, Error
+try:
+    import numba_kernels
+except ImportError:
+    numba_kernels = None
 
 
 class Miscellaneous(object):
@@ -132,21 +136,31 @@ class Miscellaneous(object):
         return meanStdDev(Laplacian(frame[::stride, ::stride], CV_32F))[1][0][0]
 
     @staticmethod
-    def local_contrast_sobel(frame, stride):
+    def local_contrast_sobel(frame, stride, use_opencl=False):
         """
         Compute a measure for local contrast in an image using the Sobel method.
 
+        The computation is done with OpenCV. If requested and OpenCL is available, the frame is
+        uploaded to the OpenCL device (via the OpenCV "transparent API"), and only the scalar result
+        is copied back. Otherwise, the same OpenCV calls are executed on the CPU. The upload only
+        pays off for whole frames. For small patches (e.g. alignment point boxes) the transfer
+        costs more than the computation.
+
         :param frame: 2D image
         :param stride: Factor for down-sampling
+        :param use_opencl: If True, use OpenCL if it is available.
         :return: Overall sharpness measure (scalar)
         """
 
-        frame_int32 = frame[::stride, ::stride].astype('int32')
-        dx = sobel(frame_int32, 0)  # vertical derivative
-        dy = sobel(frame_int32, 1)  # horizontal derivative
-        mag = hypot(dx, dy)  # magnitude
+        frame_float32 = frame[::stride, ::stride].astype(float32)
+        if use_opencl and ocl.useOpenCL():
+            frame_float32 = UMat(frame_float32)
+
+        # Use the same border treatment as the "reflect" default of scipy.ndimage.sobel.
+        dy = Sobel(frame_float32, CV_32F, 0, 1, borderType=BORDER_REFLECT)  # vertical derivative
+        dx = Sobel(frame_float32, CV_32F, 1, 0, borderType=BORDER_REFLECT)  # horizontal derivative
 
-        return mag.sum(axis=0)
+        return sumElems(magnitude(dx, dy))[0]
 
     @staticmethod
     def local_contrast(frame, stride):
@@ -160,6 +174,11 @@ class Miscellaneous(object):
         """
         frame_strided = frame[::stride, ::stride]
 
+        # If numba is available, use the compiled kernel which does all steps in a single pass.
+        if numba_kernels is not None and frame_strided.dtype == uint16 and \
+                frame_strided.shape[0] > 1 and frame_strided.shape[1] > 1:
+            return numba_kernels.local_contrast(frame_strided)
+
         # Remove a row or column, respectively, to make the dx and dy arrays of the same shape.
         dx = diff(frame_strided)[1:, :]  # remove the first row
         dy = diff(frame_strided, axis=0)[:, 1:]  # remove the first column
@@ -280,7 +299,8 @@ class Miscellaneous(object):
 
         # Compute the normalized cross correlation.
         result = matchTemplate((frame_window_first_phase).astype(float32),
-                               reference_box_first_phase.astype(float32), TM_CCORR_NORMED)
+                               reference_box_first_phase.astype(float32, copy=False),
+                               TM_CCORR_NORMED)
 
         # Determine the position of the maximum correlation and compute the corresponding warp
         # shift. The factor of 2 transforms the shift to the fine pixel grid. If a non-trivial
@@ -0,0 +1,368 @@
+# -*- coding: utf-8; -*-
+"""
+Copyright (c) 2018 Rolf Hempel, rolf6419@gmx.de
+
+This file is part of the PlanetarySystemStacker tool (PSS).
+https://github.com/Rolf-Hempel/PlanetarySystemStacker
+
+PSS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PSS.  If not, see <http://www.gnu.org/licenses/>.
+
+Compiled kernels for computationally intensive inner loops. This module requires the optional
+package "numba". Modules using it import it as follows:
+
+    try:
+        import numba_kernels
+    except ImportError:
+        numba_kernels = None
+
+If numba is not installed, the pure numpy code paths in the calling modules are used instead.
+All kernels are compiled at their first call, the compiled code is cached on disk.
+
+"""
+
+from math import sqrt
+
+from numba import njit
+from numba.typed import List
+from numpy import empty, float32, int64, uint16, rint
+
+
+@njit(nogil=True, fastmath=True, cache=True)
+def local_contrast(frame):
+    """
+    Compiled version of "Miscellaneous.local_contrast" for (already down-sampled) uint16 frames.
+    The differences in x and y, their norm, and the averaging are fused into a single pass over
+    the frame. The GIL is released, so that the kernel can be run in several threads in parallel.
+
+    Please note that "numpy.diff" on unsigned integer frames wraps around for negative
+    differences. The same is done here, so that both versions produce the same ranking.
+
+    :param frame: 2D uint16 image (at least two pixels in each direction)
+    :return: Average norm of local gradients (scalar)
+    """
+
+    dim_y, dim_x = frame.shape
+    sum_dnorm = 0.
+    for y in range(1, dim_y):
+        for x in range(1, dim_x):
+            dx = (frame[y, x] - frame[y, x - 1]) & 0xFFFF
+            dy = (frame[y, x] - frame[y - 1, x]) & 0xFFFF
+            sum_dnorm += sqrt(dx * dx + dy * dy)
+
+    return sum_dnorm / ((dim_y - 1) * (dim_x - 1))
+
+
+def buffer_list(buffers):
+    """
+    Collect arrays in a typed list, so that they can be passed to a compiled kernel.
+
+    :param buffers: Sequence of numpy arrays with the same dtype and number of dimensions
+    :return: numba.typed.List with (references to) the arrays
+    """
+
+    return List(buffers)
+
+
+@njit(nogil=True, cache=True)
+def remap_rigid(frame, buffer, channels, shift_y, shift_x, y_low, y_high, x_low, x_high,
+                borders):
+    """
+    Compiled version of "StackFrames.remap_rigid": Take a patch from the frame with a constant
+    shift in x and y directions, and add it to the stacking buffer of an alignment point.
+
+    Color frames and buffers are passed as 2D views with the color channels merged into the x
+    dimension (shape [dim_y, dim_x * channels]). Index bounds are given in pixels.
+
+    :param frame: 2D float32 frame to be stacked
+    :param buffer: 2D float32 stacking buffer of the alignment point
+    :param channels: Number of color channels (1 or 3)
+    :param shift_y: Constant shift in y direction between frame stack and current frame
+    :param shift_x: Constant shift in x direction between frame stack and current frame
+    :param y_low: Lower y index of the quality window on which this method operates
+    :param y_high: Upper y index of the quality window on which this method operates
+    :param x_low: Lower x index of the quality window on which this method operates
+    :param x_high: Upper x index of the quality window on which this method operates
+    :param borders: Integer array [y_low, y_high, x_low, x_high] with the widths of border
+                    areas not reached by all patches. The entries are updated in place.
+    :return: -
+    """
+
+    # Compute index bounds for the source patch and the target buffer, and reduce the copy area
+    # if the shift reaches beyond the frame (see "StackFrames.remap_rigid").
+    frame_size_y = frame.shape[0]
+    y_low_source = y_low + shift_y
+    y_high_source = y_high + shift_y
+    y_low_target = 0
+    if y_low_source < 0:
+        y_low_target = -y_low_source
+        y_low_source = 0
+        borders[0] = max(borders[0], y_low_target)
+    if y_high_source > frame_size_y:
+        borders[1] = max(borders[1], y_high_source - frame_size_y)
+        y_high_source = frame_size_y
+
+    frame_size_x = frame.shape[1] // channels
+    x_low_source = x_low + shift_x
+    x_high_source = x_high + shift_x
+    x_low_target = 0
+    if x_low_source < 0:
+        x_low_target = -x_low_source
+        x_low_source = 0
+        borders[2] = max(borders[2], x_low_target)
+    if x_high_source > frame_size_x:
+        borders[3] = max(borders[3], x_high_source - frame_size_x)
+        x_high_source = frame_size_x
+
+    # Add the frame contribution to the stacking buffer. In the x direction, work on merged
+    # (pixel, channel) indices. Taking row slices first lets the compiler vectorize the inner loop.
+    x_offset_source = x_low_source * channels
+    x_offset_target = x_low_target * channels
+    width = (x_high_source - x_low_source) * channels
+    for y in range(y_high_source - y_low_source):
+        buffer_row = buffer[y_low_target + y, x_offset_target:x_offset_target + width]
+        frame_row = frame[y_low_source + y, x_offset_source:x_offset_source + width]
+        for x in range(width):
+            buffer_row[x] += frame_row[x]
+
+
+@njit(nogil=True, cache=True)
+def remap_rigid_alignment_points(frame, buffers, channels, alignment_point_indices, shifts_y,
+                                 shifts_x, patch_bounds, borders):
+    """
+    Add the shifted patches of a frame to the stacking buffers of all alignment points for
+    which the frame is among the best, in a single call.
+
+    :param frame: 2D float32 frame to be stacked (see "remap_rigid" for color frames)
+    :param buffers: Typed list with the 2D stacking buffers of all alignment points
+    :param channels: Number of color channels (1 or 3)
+    :param alignment_point_indices: Integer array with the indices of the alignment points
+    :param shifts_y: Integer array with the total y shifts, one for each alignment point index
+    :param shifts_x: Integer array with the total x shifts, one for each alignment point index
+    :param patch_bounds: Integer array of shape [number of alignment points, 4] with the
+                         (drizzled) patch bounds y_low, y_high, x_low, x_high of all alignment
+                         points
+    :param borders: Integer array [y_low, y_high, x_low, x_high], updated in place (see
+                    "remap_rigid")
+    :return: -
+    """
+
+    for index in range(alignment_point_indices.shape[0]):
+        alignment_point_index = alignment_point_indices[index]
+        remap_rigid(frame, buffers[alignment_point_index], channels, shifts_y[index],
+                    shifts_x[index], patch_bounds[alignment_point_index, 0],
+                    patch_bounds[alignment_point_index, 1], patch_bounds[alignment_point_index, 2],
+                    patch_bounds[alignment_point_index, 3], borders)
+
+
+@njit(nogil=True, cache=True)
+def accumulate_patch_weights(sum_weights, weights_y, weights_x, patch_bounds, stack_size):
+    """
+    Add the blending weights of all alignment point patches to the weight sum buffer. The 2D
+    weight of a patch pixel is the minimum of the one-dimensional weight ramps in y and x,
+    multiplied with the stack size (see "StackFrames.prepare_for_stack_blending").
+
+    :param sum_weights: 2D float32 buffer with the weight sums, updated in place
+    :param weights_y: float32 array with the y weight ramps of all APs, concatenated in AP order
+    :param weights_x: float32 array with the x weight ramps of all APs, concatenated in AP order
+    :param patch_bounds: Integer array of shape [number of alignment points, 4] with the
+                         (drizzled) patch bounds y_low, y_high, x_low, x_high of all alignment
+                         points
+    :param stack_size: Number of frames stacked at each AP (float32)
+    :return: -
+    """
+
+    offset_y = 0
+    offset_x = 0
+    for index in range(patch_bounds.shape[0]):
+        y_low = patch_bounds[index, 0]
+        x_low = patch_bounds[index, 2]
+        size_y = patch_bounds[index, 1] - y_low
+        size_x = patch_bounds[index, 3] - x_low
+        ramp_x = weights_x[offset_x:offset_x + size_x]
+        for y in range(size_y):
+            weight_y = weights_y[offset_y + y]
+            sum_row = sum_weights[y_low + y, x_low:x_low + size_x]
+            for x in range(size_x):
+                sum_row[x] += stack_size * min(weight_y, ramp_x[x])
+        offset_y += size_y
+        offset_x += size_x
+
+
+@njit(nogil=True, cache=True)
+def count_below_thresholds(array, threshold_low, threshold_high):
+    """
+    Count the entries of an array below two thresholds in a single pass.
+
+    :param array: 2D float32 array
+    :param threshold_low: Lower threshold (float32)
+    :param threshold_high: Upper threshold (float32)
+    :return: (Number of entries < threshold_low, number of entries < threshold_high)
+    """
+
+    count_low = 0
+    count_high = 0
+    for y in range(array.shape[0]):
+        row = array[y]
+        for x in range(array.shape[1]):
+            value = row[x]
+            if value < threshold_low:
+                count_low += 1
+            if value < threshold_high:
+                count_high += 1
+    return count_low, count_high
+
+
+@njit(nogil=True, cache=True)
+def accumulate_background_patches(background, frame, channels, shift_y, shift_x, patch_bounds):
+    """
+    Add the globally shifted frame to the background image in all background patches, in a
+    single call (see "StackFrames.stack_frames").
+
+    Color frames and the background buffer are passed as 2D views with the color channels merged
+    into the x dimension (shape [dim_y, dim_x * channels]). Index bounds are given in pixels.
+
+    :param background: 2D float32 background image buffer, updated in place
+    :param frame: 2D float32 frame (not drizzled)
+    :param channels: Number of color channels (1 or 3)
+    :param shift_y: Global shift of the frame in y direction
+    :param shift_x: Global shift of the frame in x direction
+    :param patch_bounds: Integer array of shape [number of patches, 4] with the bounds y_low,
+                         y_high, x_low, x_high of all background patches
+    :return: -
+    """
+
+    for index in range(patch_bounds.shape[0]):
+        y_low = patch_bounds[index, 0]
+        y_high = patch_bounds[index, 1]
+        x_low = patch_bounds[index, 2] * channels
+        width = (patch_bounds[index, 3] - patch_bounds[index, 2]) * channels
+        x_low_source = x_low + shift_x * channels
+        for y in range(y_low, y_high):
+            background_row = background[y, x_low:x_low + width]
+            frame_row = frame[y + shift_y, x_low_source:x_low_source + width]
+            for x in range(width):
+                background_row[x] += frame_row[x]
+
+
+@njit(nogil=True, cache=True)
+def finalize_stacked_image(buffer, sum_weights, background, channels, blend_threshold, scale,
+                           blend, y_offset, x_offset, image):
+    """
+    Compiled version of the final steps of "StackFrames.merge_alignment_point_buffers", fused
+    into a single pass: Multiply the stacked image buffer with the reciprocal sum of weights,
+    blend it with the background image where the weights are small (optional, only pixels with
+    a foreground weight below 1 are touched), scale the result
+    to the interval [0., 1.], and convert it to 16bit integers. Border areas (see
+    "StackFrames.remap_rigid") are trimmed off by processing only the window of the buffer which
+    corresponds to the output image.
+
+    Color buffers and images are passed as 2D views with the color channels merged into the x
+    dimension (shape [dim_y, dim_x * channels]). All arithmetic is done in float32, in the same
+    order as in the numpy version (including the conversion done by "skimage.img_as_uint"), so
+    that both versions produce the same image.
+
+    :param buffer: 2D float32 stacked image buffer with the weighted sums of all AP patches
+    :param sum_weights: 2D float32 array with the weight sums (shape [dim_y, dim_x])
+    :param background: 2D float32 background image (not accessed if "blend" is False)
+    :param channels: Number of color channels (1 or 3)
+    :param blend_threshold: Weight sum (float32) above which the background is not blended in
+    :param scale: Pixel value (float32) which is mapped to 1.
+    :param blend: If True, blend the AP contributions with the background image
+    :param y_offset: Width of the trimmed border at the low y end
+    :param x_offset: Width of the trimmed border at the low x end (in pixels)
+    :param image: 2D uint16 output image (trimmed shape)
+    :return: -
+    """
+
+    zero = float32(0.)
+    one = float32(1.)
+    maximum = float32(65535.)
+    for y in range(image.shape[0]):
+        image_row = image[y]
+        buffer_row = buffer[y + y_offset, x_offset * channels:]
+        weights_row = sum_weights[y + y_offset, x_offset:]
+        background_row = background[y + y_offset, x_offset * channels:]
+        for x in range(image_row.shape[0] // channels):
+            weight = weights_row[x]
+            weight_reciprocal = one / weight
+
+            # The background is blended in only where the foreground weight is below 1.
+            blend_pixel = False
+            if blend:
+                foreground_weight = weight / blend_threshold
+                if foreground_weight < zero:
+                    foreground_weight = zero
+                blend_pixel = foreground_weight < one
+            for index in range(x * channels, (x + 1) * channels):
+                value = buffer_row[index] * weight_reciprocal
+                if blend_pixel:
+                    value = (value - background_row[index]) * foreground_weight + \
+                            background_row[index]
+                value = value / scale
+                if value < zero:
+                    value = zero
+                elif value > one:
+                    value = one
+                image_row[index] = uint16(rint(value * maximum))
+
+
+@njit(nogil=True, cache=True)
+def merge_alignment_point_buffers(buffer, stacking_buffers, channels, weights_y, weights_x,
+                                  patch_bounds, order):
+    """
+    Add the stacking buffers of all alignment points, multiplied with their blending weights, to
+    the global stacked image buffer (see "StackFrames.merge_alignment_point_buffers"). The 2D
+    weight of a patch pixel is the minimum of the one-dimensional weights in y and x.
+
+    :param buffer: 2D float32 stacked image buffer (see "remap_rigid" for color buffers), updated
+                   in place
+    :param stacking_buffers: Typed list with the 2D stacking buffers of all alignment points
+    :param channels: Number of color channels (1 or 3)
+    :param weights_y: float32 array with the y weight ramps of all APs, concatenated in AP order
+    :param weights_x: float32 array with the x weight ramps of all APs, concatenated in AP order
+    :param patch_bounds: Integer array of shape [number of alignment points, 4] with the
+                         (drizzled) patch bounds y_low, y_high, x_low, x_high of all alignment
+                         points
+    :param order: Integer array with the AP indices in the order in which the APs are processed
+    :return: -
+    """
+
+    # Compute the offsets of the APs' weight ramps in the concatenated arrays.
+    number_alignment_points = patch_bounds.shape[0]
+    offsets_y = empty(number_alignment_points, dtype=int64)
+    offsets_x = empty(number_alignment_points, dtype=int64)
+    offset_y = 0
+    offset_x = 0
+    for index in range(number_alignment_points):
+        offsets_y[index] = offset_y
+        offsets_x[index] = offset_x
+        offset_y += patch_bounds[index, 1] - patch_bounds[index, 0]
+        offset_x += patch_bounds[index, 3] - patch_bounds[index, 2]
+
+    for index in order:
+        stacking_buffer = stacking_buffers[index]
+        y_low = patch_bounds[index, 0]
+        x_low = patch_bounds[index, 2] * channels
+        size_y = patch_bounds[index, 1] - patch_bounds[index, 0]
+        size_x = patch_bounds[index, 3] - patch_bounds[index, 2]
+        ramp_y = weights_y[offsets_y[index]:offsets_y[index] + size_y]
+        ramp_x = weights_x[offsets_x[index]:offsets_x[index] + size_x]
+        for y in range(size_y):
+            weight_y = ramp_y[y]
+            buffer_row = buffer[y_low + y, x_low:x_low + size_x * channels]
+            stacking_row = stacking_buffer[y]
+            for x in range(size_x):
+                weight = min(weight_y, ramp_x[x])
+                for index_merged in range(x * channels, (x + 1) * channels):
+                    buffer_row[index_merged] += stacking_row[index_merged] * weight
@@ -20,15 +20,24 @@ along with PSS.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from glob import glob
+from hashlib import sha1
+from os import cpu_count, fdopen, makedirs, remove, replace, utime
+from os.path import abspath, dirname, getmtime, getsize, isfile, join
 from statistics import mean
+from tempfile import mkstemp
 from time import time
 
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from cv2 import meanStdDev
-from numpy import array, full
+from numpy import array, asarray, full, empty, empty_like, float64, int32, int64, argsort, \
+    partition, arange, load, savez, flatnonzero
+from numpy.lib.stride_tricks import sliding_window_view
 
 from configuration import Configuration
 from exceptions import ArgumentError, NotSupportedError, Error
@@ -44,6 +53,10 @@ class RankFrames(object):
 
     """
 
+    # Version of the ranking code, part of the key of the frame rank cache. Increase it whenever
+    # a change of the ranking code changes the quality values, so that stale ranks are not reused.
+    ranks_cache_version = 1
+
     def __init__(self, frames, configuration, progress_signal=None):
         """
         Initialize the object and instance variables.
@@ -61,7 +74,7 @@ class RankFrames(object):
         self.frames = frames
 
         self.number_original = frames.number
-        self.frame_ranks_original = []
+        self.frame_ranks_original = empty(self.number_original, dtype=float64)
         self.quality_sorted_indices_original = None
         self.rank_indices_original = None
         self.frame_ranks_max_index_original = None
@@ -77,6 +90,13 @@ class RankFrames(object):
         self.progress_signal = progress_signal
         self.signal_step_size = max(int(self.number_original / 10), 1)
 
+        # Upper bound for the number of ranks partitioned at once in "find_best_frames".
+        self.best_frames_chunk_elements = 1 << 20
+
+        # Relative tolerance within which window rank sums are considered equal in
+        # "find_best_frames". It is far above the rounding errors of the sums.
+        self.best_frames_sum_tolerance = 1.e-9
+
     def frame_score(self):
         """
         Compute the frame quality values and normalize them such that the best value is 1.
@@ -98,48 +118,32 @@ class RankFrames(object):
         if self.frames.index_translation_active:
             self.frames.reset_index_translation()
 
-        # For all frames compute the quality with the selected method.
-        if method != Miscellaneous.local_contrast_laplace:
-            for frame_index in range(self.number_original):
-                frame = self.frames.frames_mono_blurred(frame_index)
-                if self.progress_signal is not None and frame_index % self.signal_step_size == 1:
-                    self.progress_signal.emit("Rank all frames",
-                                              int(round(10*frame_index / self.number_original) * 10))
-                if self.configuration.frames_normalization:
-                    self.frame_ranks_original.append(
-                        method(frame, self.configuration.rank_frames_pixel_stride) /
-                        self.frames.average_brightness(frame_index))
-                else:
-                    self.frame_ranks_original.append(
-                        method(frame, self.configuration.rank_frames_pixel_stride))
-        else:
-            for frame_index in range(self.number_original):
-                frame = self.frames.frames_mono_blurred_laplacian(frame_index)
-                # self.frame_ranks.append(mean((frame - frame.mean())**2))
-                if self.progress_signal is not None and frame_index % self.signal_step_size == 1:
-                    self.progress_signal.emit("Rank all frames",
-                                              int(round(10*frame_index / self.number_original) * 10))
-                if self.configuration.frames_normalization:
-                    self.frame_ranks_original.append(meanStdDev(frame)[1][0][0] /
-                        self.frames.average_brightness(frame_index))
-                else:
-                    self.frame_ranks_original.append(meanStdDev(frame)[1][0][0])
+        # Look up the raw quality values in the disk cache. If they are not available, compute them
+        # and store them in the cache for subsequent runs on the same input.
+        cache_file = self.ranks_cache_file()
+        if not self.load_frame_ranks(cache_file):
+            self.score_all_frames(method)
+            self.save_frame_ranks(cache_file)
 
-        # Sort the frame indices in descending order of quality.
-        self.quality_sorted_indices_original = sorted(range(self.number_original),
-                                             key=self.frame_ranks_original.__getitem__, reverse=True)
+        # Sort the frame indices in descending order of quality. A stable sort of the negated
+        # values keeps frames with equal quality in chronological order.
+        # 32bit indices are sufficient for any frame count and halve the memory.
+        self.quality_sorted_indices_original = argsort(-self.frame_ranks_original,
+                                                       kind='stable').astype(int32)
 
         # Compute the inverse index list: For each frame the rank_index is the corresponding index
         # in the sorted frame_ranks list.
-        self.rank_indices_original = [self.quality_sorted_indices_original.index(index) for index in
-                             range(self.number_original)]
+        self.rank_indices_original = empty_like(self.quality_sorted_indices_original)
+        self.rank_indices_original[self.quality_sorted_indices_original] = \
+            arange(self.number_original, dtype=int32)
 
         if self.progress_signal is not None:
             self.progress_signal.emit("Rank all frames", 100)
 
         # Set the index of the best frame, and normalize all quality values.
-        self.frame_ranks_max_index_original = self.quality_sorted_indices_original[0]
-        self.frame_ranks_max_value_original = self.frame_ranks_original[self.frame_ranks_max_index_original]
+        self.frame_ranks_max_index_original = int(self.quality_sorted_indices_original[0])
+        self.frame_ranks_max_value_original = \
+            self.frame_ranks_original[self.frame_ranks_max_index_original]
         self.frame_ranks_original /= self.frame_ranks_max_value_original
 
         # Keep the original ranking data and prepare for index translation. The translation can be
@@ -151,6 +155,200 @@ class RankFrames(object):
         self.frame_ranks_max_index = self.frame_ranks_max_index_original
         self.frame_ranks_max_value = self.frame_ranks_max_value_original
 
+    def score_all_frames(self, method):
+        """
+        Compute the quality values of all frames and store them in "frame_ranks_original". If
+        frames are normalized, the values are divided by the frame brightness. They are not yet
+        normalized to a maximum of 1.
+
+        :param method: Ranking method selected in "frame_score"
+        :return: -
+        """
+
+        # Select the frame source and the scoring function once, so that the loop below does not
+        # branch on the ranking method. The Laplace method works on the (down-sampled) Laplacians
+        # of the blurred frames. All other methods work on the blurred monochrome frames directly.
+        if method == Miscellaneous.local_contrast_laplace:
+            frame_source = self.frames.frames_mono_blurred_laplacian
+            score = self.score_laplacian
+        elif method == Miscellaneous.local_contrast_sobel:
+            # Whole frames are large enough to be computed on an OpenCL device (if available).
+            frame_source = self.frames.frames_mono_blurred
+            score = partial(method, stride=self.configuration.rank_frames_pixel_stride,
+                            use_opencl=True)
+        else:
+            frame_source = self.frames.frames_mono_blurred
+            score = partial(method, stride=self.configuration.rank_frames_pixel_stride)
+
+        # For all frames compute the quality with the selected method. Frame access is not
+        # thread-safe, so frames are looked up sequentially in this thread. The quality
+        # computations are independent of each other and are executed in a pool of worker threads.
+        # OpenCV and numpy release the GIL in their compute kernels, so the workers run in parallel.
+        # The number of pending frames is bounded to limit memory consumption.
+        number_workers = cpu_count() or 1
+        pending = deque()
+
+        # Precompute the frame indices after which a progress signal is sent to the main GUI.
+        if self.progress_signal is not None:
+            signal_indices = frozenset(range(1, self.number_original, self.signal_step_size))
+        else:
+            signal_indices = frozenset()
+
+        with ThreadPoolExecutor(max_workers=number_workers) as executor:
+            for frame_index in range(self.number_original):
+                frame = frame_source(frame_index)
+                pending.append((frame_index, executor.submit(score, frame)))
+                if frame_index in signal_indices:
+                    self.progress_signal.emit("Rank all frames",
+                                              int(round(10*frame_index / self.number_original) * 10))
+                if len(pending) > 2 * number_workers:
+                    index, future = pending.popleft()
+                    self.frame_ranks_original[index] = future.result()
+            for index, future in pending:
+                self.frame_ranks_original[index] = future.result()
+
+        # The average brightness of each frame has been computed together with the monochrome
+        # frame. Divide all quality values by the brightness in a single array operation.
+        if self.configuration.frames_normalization:
+            self.frame_ranks_original /= self.frames.average_brightness_original()
+
+    def ranks_cache_file(self):
+        """
+        Compose the name of the disk cache file for the frame ranks. The name contains a hash over
+        the input files (names, modification times and sizes) and all parameters which influence
+        the ranking. If any of them changes, the ranks are computed anew.
+
+        :return: Full path name of the cache file, or None if ranks are not to be cached.
+        """
+
+        cache_dir = self.configuration.rank_frames_cache_dir
+
+        # The cache is switched off by setting its size to 0. Calibration frames are not part of
+        # the key, so do not cache ranks of calibrated frames.
+        if cache_dir is None or self.configuration.frames_ranks_cache_size <= 0 or \
+                self.frames.calibration_matches:
+            return None
+
+        if self.frames.type == 'video':
+            file_names = [self.frames.names]
+        else:
+            file_names = list(self.frames.names)
+        try:
+            file_stamps = [(abspath(name), getmtime(name), getsize(name)) for name in file_names]
+        except (OSError, TypeError):
+            return None
+
+        key = repr((self.ranks_cache_version, file_stamps, self.number_original,
+                    self.frames.bayer_option_selected,
+                    self.frames.bayer_pattern, self.configuration.frames_debayering_method,
+                    self.configuration.frames_mono_channel, self.configuration.frames_gauss_width,
+                    self.configuration.frames_normalization,
+                    self.configuration.frames_normalization_threshold,
+                    self.configuration.rank_frames_method,
+                    self.configuration.rank_frames_pixel_stride,
+                    self.configuration.align_frames_sampling_stride))
+
+        return join(cache_dir, "ranks_" + sha1(key.encode()).hexdigest() + ".npz")
+
+    def load_frame_ranks(self, cache_file):
+        """
+        Read the raw quality values of all frames from the disk cache. If frames are normalized,
+        their average brightness values are restored as well. Later workflow steps need them, but
+        they are computed only when the monochrome frames are decoded.
+
+        :param cache_file: Name of the cache file (see "ranks_cache_file"), or None.
+        :return: True, if the values have been read into "frame_ranks_original". False otherwise.
+        """
+
+        if cache_file is None or not isfile(cache_file):
+            return False
+
+        # A damaged (e.g. truncated) or outdated cache file is ignored, the ranks are computed anew
+        # in this case. The file is overwritten then.
+        try:
+            with load(cache_file) as cache_data:
+                frame_ranks = cache_data['frame_ranks']
+                if self.configuration.frames_normalization:
+                    average_brightness = cache_data['average_brightness']
+                else:
+                    average_brightness = None
+        except Exception:
+            return False
+        if frame_ranks.shape != self.frame_ranks_original.shape or (
+                average_brightness is not None and
+                average_brightness.shape != self.frames.frames_average_brightness.shape):
+            return False
+
+        self.frame_ranks_original[:] = frame_ranks
+        if average_brightness is not None:
+            self.frames.frames_average_brightness[:] = average_brightness
+
+        # Mark the file as recently used, so that it is not removed when the cache is trimmed.
+        try:
+            utime(cache_file)
+        except OSError:
+            pass
+        return True
+
+    def save_frame_ranks(self, cache_file):
+        """
+        Write the raw quality values of all frames to the disk cache. Failures are ignored, the
+        cache is an optimization only.
+
+        :param cache_file: Name of the cache file (see "ranks_cache_file"), or None.
+        :return: -
+        """
+
+        if cache_file is None:
+            return
+
+        # Write the data to a temporary file in the cache directory first, and then rename it. This
+        # way an interrupted write (e.g. if the disk is full) never leaves a broken cache file.
+        cache_dir = dirname(cache_file)
+        temp_file = None
+        try:
+            makedirs(cache_dir, exist_ok=True)
+            handle, temp_file = mkstemp(prefix="ranks_", suffix=".tmp", dir=cache_dir)
+            with fdopen(handle, 'wb') as temp:
+                if self.configuration.frames_normalization:
+                    savez(temp, frame_ranks=self.frame_ranks_original,
+                          average_brightness=self.frames.frames_average_brightness)
+                else:
+                    savez(temp, frame_ranks=self.frame_ranks_original)
+            replace(temp_file, cache_file)
+        except OSError:
+            if temp_file is not None and isfile(temp_file):
+                try:
+                    remove(temp_file)
+                except OSError:
+                    pass
+            return
+
+        # Keep at most "frames_ranks_cache_size" files in the cache. Remove the least recently used
+        # ones.
+        try:
+            cache_files = sorted(glob(join(cache_dir, "ranks_*.npz")), key=getmtime)
+            for old_file in cache_files[:-self.configuration.frames_ranks_cache_size]:
+                remove(old_file)
+        except OSError:
+            pass
+
+    @staticmethod
+    def score_laplacian(frame):
+        """
+        Compute the quality value of a frame with the "Laplace" method. This method is executed in
+        a worker thread.
+
+        :param frame: Down-sampled Laplacian of a blurred monochrome frame
+        :return: Quality value of the frame
+        """
+
+        # The standard deviation of the Laplacian is used as the quality measure. Squaring it (to
+        # get the variance) would not change the ranking. OpenCV computes it in a single pass on
+        # the 8bit Laplacian, which is more than ten times faster than numpy.std (which converts
+        # the frame to float first).
+        return meanStdDev(frame)[1][0, 0]
+
     def set_index_translation(self, index_translation):
         """
         After frames have been marked to be excluded from the further workflow, update the ranking
@@ -164,22 +362,24 @@ class RankFrames(object):
         # Set the number of ranks to the number of included frames.
         self.number = len(index_translation)
 
-        self.frame_ranks = [self.frame_ranks_original[index] for index in index_translation]
+        # Gather the ranks of the included frames into a new array. It is normalized in place
+        # below, so the original ranks are not changed.
+        self.frame_ranks = self.frame_ranks_original[asarray(index_translation, dtype=int64)]
 
-        # Sort the frame indices in descending order of quality.
-        self.quality_sorted_indices = sorted(range(self.number),
-                                             key=self.frame_ranks.__getitem__, reverse=True)
+        # Sort the frame indices in descending order of quality. As in "frame_score", a stable sort
+        # of the negated values keeps frames with equal quality in chronological order.
+        self.quality_sorted_indices = argsort(-self.frame_ranks, kind='stable').astype(int32)
 
         # Compute the inverse index list: For each frame the rank_index is the corresponding index
         # in the sorted frame_ranks list.
-        self.rank_indices = [self.quality_sorted_indices.index(index) for index in
-                             range(self.number)]
+        self.rank_indices = empty_like(self.quality_sorted_indices)
+        self.rank_indices[self.quality_sorted_indices] = arange(self.number, dtype=int32)
 
         if self.progress_signal is not None:
             self.progress_signal.emit("Rank all frames", 100)
 
         # Set the index of the best frame, and normalize all quality values.
-        self.frame_ranks_max_index = self.quality_sorted_indices[0]
+        self.frame_ranks_max_index = int(self.quality_sorted_indices[0])
         self.frame_ranks_max_value = self.frame_ranks[self.frame_ranks_max_index]
         self.frame_ranks /= self.frame_ranks_max_value
 
@@ -190,6 +390,10 @@ class RankFrames(object):
         :return: -
         """
 
+        # If index translation is not active, the original data are in place already.
+        if self.frame_ranks is self.frame_ranks_original:
+            return
+
         self.number = self.number_original
         self.frame_ranks = self.frame_ranks_original
         self.quality_sorted_indices = self.quality_sorted_indices_original
@@ -219,21 +423,51 @@ class RankFrames(object):
             raise ArgumentError("Size of best frames region " + str(region_size) + " larger "
                                 "than the total number of frames " + str(self.number))
 
-        best_indices = []
+        ranks = asarray(self.frame_ranks)
+        best_start_index = None
         rank_sum_opt = 0.
 
         # Construct a sliding window on the full index range. For each window position find the
         # best "number_frames" frames. Find the window and the best frame set within with the
-        # highest overall score.
-        for start_index in range(self.number - region_size + 1):
-            end_index = start_index + region_size
-            best_indices_in_range = sorted(range(start_index, end_index),
-                                           key=self.frame_ranks.__getitem__, reverse=True)[
-                                    :number_frames]
-            rank_sum = sum([self.frame_ranks[i] for i in best_indices_in_range])
-            if rank_sum > rank_sum_opt:
-                rank_sum_opt = rank_sum
-                best_indices = best_indices_in_range
+        # highest overall score. A partial sort is sufficient to find the best frames, their order
+        # does not matter for the sum. The windows are views into the ranks array. They are
+        # processed in chunks to limit the size of the partitioned copy.
+        if number_frames == region_size:
+            # All frames of a window are selected. The window sums are differences of the
+            # cumulative sum, no partial sorts are needed.
+            cumulative_sum = empty(self.number + 1, dtype=float64)
+            cumulative_sum[0] = 0.
+            ranks.cumsum(out=cumulative_sum[1:])
+            rank_sums = cumulative_sum[region_size:] - cumulative_sum[:-region_size]
+        else:
+            windows = sliding_window_view(ranks, region_size)
+            number_windows = windows.shape[0]
+            chunk_size = max(1, self.best_frames_chunk_elements // region_size)
+            rank_sums = empty(number_windows, dtype=float64)
+            for chunk_start in range(0, number_windows, chunk_size):
+                chunk_end = min(chunk_start + chunk_size, number_windows)
+                rank_sums[chunk_start:chunk_end] = partition(
+                    windows[chunk_start:chunk_end], region_size - number_frames,
+                    axis=1)[:, region_size - number_frames:].sum(axis=1)
+
+        # Take the first window with the highest sum. The window sums are not all added in the
+        # same order (partitioning, differences of cumulative sums), so windows with equal sums
+        # may differ by rounding errors. Therefore, sums within a small relative tolerance of the
+        # maximum are treated as equal.
+        rank_sum_max = rank_sums.max()
+        if rank_sum_max > rank_sum_opt:
+            best_start_index = int(flatnonzero(
+                rank_sums >= rank_sum_max - self.best_frames_sum_tolerance * rank_sum_max)[0])
+            rank_sum_opt = rank_sums[best_start_index]
+
+        # Only for the optimal window sort the frames by quality. As above, equal qualities are
+        # kept in chronological order.
+        if best_start_index is not None:
+            window = ranks[best_start_index:best_start_index + region_size]
+            best_indices = (best_start_index +
+                            argsort(-window, kind='stable')[:number_frames]).tolist()
+        else:
+            best_indices = []
 
         # Compare the average frame quality with the optimal choice if no time restrictions were
         # present.
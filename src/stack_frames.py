@@ -21,8 +21,10 @@ along with PSS.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 #from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from math import ceil
-from statistics import median
+from os import cpu_count
 from time import sleep
 from warnings import filterwarnings
 
@@ -31,13 +33,23 @@ from warnings import filterwarnings
 #import matplotlib.pyplot as plt
 from cv2 import FONT_HERSHEY_SIMPLEX, putText, resize, INTER_CUBIC, INTER_LINEAR
 from numpy import zeros, full, empty, float32, newaxis, arange, count_nonzero, \
-    sqrt, uint16, clip, minimum, mean
-from skimage import img_as_uint, img_as_ubyte
+    sqrt, uint16, clip, minimum, mean, int64, asarray, concatenate, multiply, copyto, \
+    float64, int32, cumsum, rint, bincount, median, true_divide, reciprocal, flatnonzero, \
+    lexsort, subtract, add, array_split, argsort, repeat, diff, split
+from skimage import img_as_ubyte
 
 from align_frames import AlignFrames
 from alignment_points import AlignmentPoints
 from configuration import Configuration
 from exceptions import InternalError, NotSupportedError, Error
+try:
+    import numba_kernels
+except ImportError:
+    numba_kernels = None
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 from frames import Frames
 from miscellaneous import Miscellaneous
 from rank_frames import RankFrames
@@ -106,29 +118,34 @@ class StackFrames(object):
         self.number_pixels_drizzled = self.dim_y_drizzled * self.dim_x_drizzled
 
         # Allocate AP stacking buffers and compute drizzled patch index bounds.
-        for ap in self.alignment_points.alignment_points:
-            AlignmentPoints.initialize_ap_stacking_buffer(ap, self.configuration.drizzle_factor,
-                                             self.frames.color)
+        self.alignment_points.initialize_ap_stacking_buffers(self.configuration.drizzle_factor,
+                                                             self.frames.color)
 
         # The summation buffer needs to accommodate three color channels in the case of color
-        # images. The size is extended if drizzling is active. In this case also allocate a buffer
-        # where the interpolated frames are stored.
+        # images. The size is extended if drizzling is active.
         if self.frames.color:
             self.stacked_image_buffer = zeros([self.dim_y_drizzled, self.dim_x_drizzled, 3],
                                               dtype=float32)
-            if self.drizzle:
-                self.frame_drizzled = zeros([self.dim_y_drizzled, self.dim_x_drizzled, 3],
-                                                  dtype=float32)
         else:
             self.stacked_image_buffer = zeros([self.dim_y_drizzled, self.dim_x_drizzled],
                                               dtype=float32)
-            if self.drizzle:
-                self.frame_drizzled = zeros([self.dim_y_drizzled, self.dim_x_drizzled],
-                                                  dtype=float32)
+
+        # Allocate a buffer for the current frame, converted to float32 (and normalized in
+        # brightness). If drizzle is active, also allocate a buffer where the interpolated frame
+        # is stored. Otherwise, the float32 frame is used directly. The buffers are re-used for all
+        # frames.
+        self.frame_float32 = empty(self.frames.shape, dtype=float32)
+        if self.drizzle:
+            self.frame_drizzled = empty((self.frames.shape[0] * self.configuration.drizzle_factor,
+                                         self.frames.shape[1] * self.configuration.drizzle_factor)
+                                        + tuple(self.frames.shape[2:]), dtype=float32)
+        else:
+            self.frame_drizzled = self.frame_float32
 
         # If the alignment point patches do not cover the entire frame, a background image must
         # be computed and blended in. At this point it is not yet clear if this is necessary.
         self.background_patches = None
+        self.background_patch_bounds = None
         self.averaged_background = None
 
         # Allocate a buffer which for each pixel of the image accumulates the weights at each pixel.
@@ -137,6 +154,12 @@ class StackFrames(object):
         self.sum_single_frame_weights = full([self.dim_y_drizzled, self.dim_x_drizzled], 1.e-30,
                                              dtype=float32)
 
+        # If the compiled kernels are available, the one-dimensional blending weights of all APs
+        # (concatenated in AP order) and 2D views of the AP stacking buffers are kept for them.
+        self.patch_weights_y = None
+        self.patch_weights_x = None
+        self.stacking_buffers = None
+
         # Prepare for debugging the local de-warping: In each frame a shifted AP patch can be
         # compared to the corresponding section of the reference frame. This is visualized in a
         # separate GUI window. Visualization control is done via three signals passed from the
@@ -167,6 +190,12 @@ class StackFrames(object):
         # The stack size is the number of frames which contribute to each AP stack.
         single_stack_size_float = float(self.alignment_points.stack_size)
 
+        # If the compiled kernels are available, the one-dimensional weight ramps of all APs are
+        # collected, and the weights are added to the buffer in a single call below.
+        if numba_kernels is not None:
+            weights_y_list = []
+            weights_x_list = []
+
         # Add the contributions of all alignment points into a single buffer.
         for alignment_point in self.alignment_points.alignment_points:
             patch_y_low_drizzled = alignment_point['patch_y_low_drizzled']
@@ -182,19 +211,17 @@ class StackFrames(object):
             extend_low_x = patch_x_low_drizzled == 0
             extend_high_x = patch_x_high_drizzled == self.dim_x_drizzled
 
-            # Compute the weights used in AP blending and store them with the AP.
-            alignment_point['weights_yx'] = minimum(self.one_dim_weight(patch_y_low_drizzled,
-                                                                        patch_y_high_drizzled,
-                                                                        alignment_point['y_drizzled'],
-                                                                        extend_low=extend_low_y,
-                                                                        extend_high=extend_high_y)[
-                                                                                    :, newaxis],
-                                                    self.one_dim_weight(patch_x_low_drizzled,
-                                                                        patch_x_high_drizzled,
-                                                                        alignment_point['x_drizzled'],
-                                                                        extend_low=extend_low_x,
-                                                                        extend_high=extend_high_x)[
-                                                                                    newaxis, :])
+            # Compute the weights used in AP blending and store them with the AP. The 2D weight
+            # at a patch pixel is the minimum of the one-dimensional weights in y and x. Only the
+            # one-dimensional weights are stored, the 2D weights are expanded where they are used.
+            weights_y = self.one_dim_weight(patch_y_low_drizzled, patch_y_high_drizzled,
+                                            alignment_point['y_drizzled'],
+                                            extend_low=extend_low_y, extend_high=extend_high_y)
+            weights_x = self.one_dim_weight(patch_x_low_drizzled, patch_x_high_drizzled,
+                                            alignment_point['x_drizzled'],
+                                            extend_low=extend_low_x, extend_high=extend_high_x)
+            alignment_point['weights_y'] = weights_y
+            alignment_point['weights_x'] = weights_x
 
             # This is an alternative where the weights decrease more rapidly towards the corners.
             # alignment_point['weights_yx'] = self.one_dim_weight(patch_y_low, patch_y_high,
@@ -205,12 +232,35 @@ class StackFrames(object):
             #                                     extend_high=extend_high_x)
 
             # For each image buffer pixel add the weights. This is used for normalization later.
-            self.sum_single_frame_weights[patch_y_low_drizzled:patch_y_high_drizzled,
-            patch_x_low_drizzled: patch_x_high_drizzled] += single_stack_size_float \
-                                                            * alignment_point['weights_yx']
-
-        # Compute the fraction of pixels where no AP patch contributes.
-        self.number_stacking_holes = count_nonzero(self.sum_single_frame_weights < 1.e-10)
+            if numba_kernels is not None:
+                weights_y_list.append(weights_y)
+                weights_x_list.append(weights_x)
+            else:
+                self.sum_single_frame_weights[patch_y_low_drizzled:patch_y_high_drizzled,
+                patch_x_low_drizzled: patch_x_high_drizzled] += single_stack_size_float \
+                    * minimum(weights_y[:, newaxis], weights_x[newaxis, :])
+
+        if numba_kernels is not None and weights_y_list:
+            self.patch_weights_y = concatenate(weights_y_list)
+            self.patch_weights_x = concatenate(weights_x_list)
+            numba_kernels.accumulate_patch_weights(self.sum_single_frame_weights,
+                                                   self.patch_weights_y, self.patch_weights_x,
+                                                   self.alignment_points.patch_bounds_drizzled,
+                                                   float32(single_stack_size_float))
+
+        # Compute the number of pixels where no AP patch contributes, and the number of points
+        # where the background image will be used in patch blending. If available, a compiled
+        # kernel counts both in a single pass. Thresholds are passed as float32 to compare in the
+        # same precision as numpy does.
+        background_threshold = self.configuration.stack_frames_background_blend_threshold * \
+                               single_stack_size_float
+        if numba_kernels is not None:
+            self.number_stacking_holes, points_where_background_used = \
+                numba_kernels.count_below_thresholds(self.sum_single_frame_weights,
+                                                     float32(1.e-10),
+                                                     float32(background_threshold))
+        else:
+            self.number_stacking_holes = count_nonzero(self.sum_single_frame_weights < 1.e-10)
 
         # If all pixels are covered by AP patches, no background image is required.
         if self.number_stacking_holes == 0:
@@ -229,10 +279,9 @@ class StackFrames(object):
         else:
             self.averaged_background = zeros([self.dim_y, self.dim_x], dtype=float32)
 
-        # Compute the number of points where the background image will be used in patch blending.
-        points_where_background_used = count_nonzero(self.sum_single_frame_weights <
-                                     self.configuration.stack_frames_background_blend_threshold *
-                                     single_stack_size_float)
+        if numba_kernels is None:
+            points_where_background_used = count_nonzero(self.sum_single_frame_weights <
+                                                         background_threshold)
 
         # If the fraction is below a certain limit, it is worthwhile to compute the background
         # image only where it is needed. Construct a list with patches where the background is
@@ -243,32 +292,42 @@ class StackFrames(object):
             # Initialize a list of background patches.
             self.background_patches = []
 
+            # Build an integral image (summed area table) of the pixels where the background is
+            # used. The number of such pixels in any patch then follows from four lookups, instead
+            # of a scan over the patch.
+            background_used = zeros((self.dim_y_drizzled + 1, self.dim_x_drizzled + 1),
+                                    dtype=int32)
+            cumsum(self.sum_single_frame_weights < background_threshold, axis=0, dtype=int32,
+                   out=background_used[1:, 1:])
+            cumsum(background_used[1:, 1:], axis=1, out=background_used[1:, 1:])
+
+            # Look up the parameters used in the patch loops only once.
+            drizzle_factor = self.configuration.drizzle_factor
+            patch_size = self.configuration.stack_frames_background_patch_size
+            dim_y = self.dim_y
+            dim_x = self.dim_x
+
             # Subdivide the image area in quadratic patches. Cycle through all patch locations.
-            for patch_y_low in range(0, self.dim_y,
-                                     self.configuration.stack_frames_background_patch_size):
-                patch_y_high = min(
-                    patch_y_low + self.configuration.stack_frames_background_patch_size,
-                    self.dim_y - 1)
+            for patch_y_low in range(0, dim_y, patch_size):
+                patch_y_high = min(patch_y_low + patch_size, dim_y - 1)
 
                 # Handle the special case where the patch has zero size in one direction.
                 if patch_y_low == patch_y_high:
                     continue
-                for patch_x_low in range(0, self.dim_x,
-                                         self.configuration.stack_frames_background_patch_size):
-                    patch_x_high = min(
-                        patch_x_low + self.configuration.stack_frames_background_patch_size,
-                        self.dim_x - 1)
+                for patch_x_low in range(0, dim_x, patch_size):
+                    patch_x_high = min(patch_x_low + patch_size, dim_x - 1)
                     if patch_x_low == patch_x_high:
                         continue
 
                     # If the patch contains pixels where the background is used, add it to the list.
-                    if count_nonzero(self.sum_single_frame_weights[
-                                     patch_y_low * self.configuration.drizzle_factor:
-                                     patch_y_high * self.configuration.drizzle_factor,
-                                     patch_x_low * self.configuration.drizzle_factor:
-                                     patch_x_high * self.configuration.drizzle_factor] <
-                                     self.configuration.stack_frames_background_blend_threshold *
-                                     single_stack_size_float) > 0:
+                    y_low_drizzled = patch_y_low * drizzle_factor
+                    y_high_drizzled = patch_y_high * drizzle_factor
+                    x_low_drizzled = patch_x_low * drizzle_factor
+                    x_high_drizzled = patch_x_high * drizzle_factor
+                    if background_used[y_high_drizzled, x_high_drizzled] - \
+                            background_used[y_low_drizzled, x_high_drizzled] - \
+                            background_used[y_high_drizzled, x_low_drizzled] + \
+                            background_used[y_low_drizzled, x_low_drizzled] > 0:
                         background_patch = {}
                         background_patch['patch_y_low'] = patch_y_low
                         background_patch['patch_y_high'] = patch_y_high
@@ -276,6 +335,13 @@ class StackFrames(object):
                         background_patch['patch_x_high'] = patch_x_high
                         self.background_patches.append(background_patch)
 
+            # Collect the patch bounds in an array as well, so that the background contribution
+            # of a frame can be added to all patches in a single kernel call.
+            self.background_patch_bounds = asarray(
+                [[patch['patch_y_low'], patch['patch_y_high'], patch['patch_x_low'],
+                  patch['patch_x_high']] for patch in self.background_patches],
+                dtype=int64).reshape(-1, 4)
+
         self.my_timer.stop('Stacking: initialize background blending')
 
     def stack_frames(self):
@@ -308,13 +374,11 @@ class StackFrames(object):
                 (self.configuration.alignment_points_search_width - search_width_second_phase) / 2)
             search_width_first_phase = max_search_width_first_phase
             extent = 2 * search_width_first_phase + 1
-            weight_matrix_first_phase = empty((extent, extent), dtype=float32)
-            for y in range(extent):
-                for x in range(extent):
-                    weight_matrix_first_phase[
-                        y, x] = 1. - self.configuration.alignment_points_penalty_factor * (
-                            (y / search_width_first_phase - 1) ** 2 + (
-                            x / search_width_first_phase - 1) ** 2)
+            # The penalty is computed in double precision for all (y, x) at once, using broadcasting
+            # of the squared distances in y and x.
+            squared_distances = (arange(extent) / search_width_first_phase - 1) ** 2
+            weight_matrix_first_phase = (1. - self.configuration.alignment_points_penalty_factor * (
+                squared_distances[:, newaxis] + squared_distances[newaxis, :])).astype(float32)
 
         else:
             weight_matrix_first_phase = None
@@ -324,9 +388,10 @@ class StackFrames(object):
             self.create_image_window_signal.emit()
 
         # If brightness normalization is switched on, prepare for adjusting frame brightness.
+        # Look up the brightness values of all frames once.
         if self.configuration.frames_normalization:
-            median_brightness = median([self.frames.average_brightness(index)
-                                        for index in range(self.frames.number)])
+            average_brightness = self.frames.average_brightness_all()
+            median_brightness = median(average_brightness)
             # print ("min: " + str(min(self.frames.frames_average_brightness)) + ", median: "
             #        + str(median_brightness) + ", max: "
             #        + str(max(self.frames.frames_average_brightness)))
@@ -334,149 +399,177 @@ class StackFrames(object):
         # Initialize widths of border areas where artifacts occur because not all patches contribute.
         self.border_y_low = self.border_y_high = self.border_x_low = self.border_x_high = 0
 
-        # Go through the list of all frames.
-        for frame_index in range(self.frames.number):
-
-            # If brightness normalization is switched on, change the brightness of this frame to
-            # the median of all frames.
-            if self.configuration.frames_normalization:
-                frame = self.frames.frames(frame_index) * median_brightness / \
-                        (self.frames.average_brightness(frame_index) + 1.e-7)
-            else:
-                frame = self.frames.frames(frame_index)
-
-            # Change the current frame into float32. If drizzle is active, also interpolate values.
-            if self.drizzle:
-                self.frame_drizzled = resize(frame.astype(float32),
-                                             (frame.shape[1]*self.configuration.drizzle_factor, frame.shape[0]*self.configuration.drizzle_factor),
-                                             interpolation=INTER_LINEAR)
-            else:
-                self.frame_drizzled = frame.astype(float32)
-
-            frame_mono_blurred = self.frames.frames_mono_blurred(frame_index)
-
-            # After every "signal_step_size"th frame, send a progress signal to the main GUI.
-            if self.progress_signal is not None and frame_index % self.signal_step_size == 1:
-                self.progress_signal.emit("Stack frames",
-                                          int(round(10 * frame_index / self.frames.number) * 10))
-
-            # Look up the constant shifts of the given frame with respect to the mean frame.
-            dy = self.align_frames.dy[frame_index]
-            dx = self.align_frames.dx[frame_index]
-
-            # Go through all alignment points for which this frame was found to be among the best.
-            for alignment_point_index in self.frames.used_alignment_points[frame_index]:
-                alignment_point = self.alignment_points.alignment_points[alignment_point_index]
+        # Look up configuration parameters and objects used in the frame and AP loops only once.
+        drizzle_factor = self.configuration.drizzle_factor
+        frames_normalization = self.configuration.frames_normalization
+        de_warp = self.configuration.alignment_points_de_warp
+        debug = self.debug
+        alignment_point_list = self.alignment_points.alignment_points
+
+        # If the compiled kernels are available, prepare the data they need for adding the patches
+        # of a frame to all AP stacking buffers in a single call: 2D views of the buffers (color
+        # channels merged into the x dimension), the AP patch bounds, and the border widths.
+        if numba_kernels is not None:
+            channels = 3 if self.frames.color else 1
+            self.stacking_buffers = numba_kernels.buffer_list(
+                [alignment_point['stacking_buffer'].reshape(
+                    alignment_point['stacking_buffer'].shape[0], -1)
+                 for alignment_point in alignment_point_list])
+            borders = zeros(4, dtype=int64)
+
+        # Mark the frames which contribute to the background image (if there are holes between
+        # AP patches). These are the best frames of the whole stack.
+        background_frames = zeros(self.frames.number, dtype=bool)
+        background_frames[
+            self.rank_frames.quality_sorted_indices[:self.alignment_points.stack_size]] = True
+
+        # Progress signals are sent at frames 1, 1 + signal_step_size, ... Keep track of the next
+        # one, so that the frame loop only compares two integers.
+        next_signal_frame = 1 if self.progress_signal is not None else self.frames.number
+
+        # Start the worker threads for the AP shift computations. They are shut down when the
+        # frame loop is left, also if an exception is raised.
+        number_workers = cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=number_workers) as executor:
+
+            # Go through the list of all frames.
+            for frame_index in range(self.frames.number):
+
+                # Change the current frame into float32. If brightness normalization is switched on,
+                # change the brightness of this frame to the median of all frames in the same pass.
+                # The product is computed in double precision and rounded when it is stored. If the
+                # scale factor deviates from 1 by less than 2**-25, rounding the product of any
+                # 16bit pixel value to float32 gives the pixel value itself, so the frame is only
+                # copied.
+                if frames_normalization:
+                    scale = median_brightness / (average_brightness[frame_index] + 1.e-7)
+                else:
+                    scale = 1.
+                if abs(scale - 1.) < 2. ** -25:
+                    copyto(self.frame_float32, self.frames.frames(frame_index))
+                else:
+                    multiply(self.frames.frames(frame_index), scale, out=self.frame_float32,
+                             dtype=float64)
+                frame = self.frame_float32
 
-                # Compute the local warp shift for this frame.
+                # If drizzle is active, interpolate the frame into the pre-allocated drizzle buffer.
+                # Be careful: OpenCV resize expects the "width" dimension first!
+                if self.drizzle:
+                    resize(frame, (self.frame_drizzled.shape[1], self.frame_drizzled.shape[0]),
+                           dst=self.frame_drizzled, interpolation=INTER_LINEAR)
+
+                frame_mono_blurred = self.frames.frames_mono_blurred(frame_index)
+
+                # After every "signal_step_size"th frame, send a progress signal to the main GUI.
+                if frame_index == next_signal_frame:
+                    self.progress_signal.emit(
+                        "Stack frames", int(round(10 * frame_index / self.frames.number) * 10))
+                    next_signal_frame += self.signal_step_size
+
+                # Look up the constant shifts of the given frame with respect to the mean frame.
+                dy = self.align_frames.dy[frame_index]
+                dx = self.align_frames.dx[frame_index]
+
+                # Go through all alignment points for which this frame was found to be among the
+                # best. First compute the total patch shifts for all of them.
+                alignment_point_indices = self.frames.used_alignment_points[frame_index]
+
+                # Compute the local warp shifts of this frame at all these APs. The computations are
+                # independent of each other. They are executed in a pool of worker threads (OpenCV
+                # releases the GIL in the correlation kernels). With a single worker, or only a few
+                # APs, the thread pool costs more than it saves. Then the shifts are computed in
+                # this thread.
+                if number_workers > 1 and len(alignment_point_indices) >= 2 * number_workers:
+                    shift_map = executor.map
+                else:
+                    shift_map = map
                 self.my_timer.start('Stacking: compute AP shifts')
-                [shift_y, shift_x], success = self.alignment_points.compute_shift_alignment_point(
-                    frame_mono_blurred, frame_index, alignment_point_index,
-                    de_warp=self.configuration.alignment_points_de_warp,
-                    weight_matrix_first_phase=weight_matrix_first_phase,
-                    subpixel_solve=self.drizzle)
+                shift_results = list(shift_map(
+                    partial(self.alignment_points.compute_shift_alignment_point, frame_mono_blurred,
+                            frame_index, de_warp=de_warp,
+                            weight_matrix_first_phase=weight_matrix_first_phase,
+                            subpixel_solve=self.drizzle), alignment_point_indices))
+                shifts_y = asarray([shift[0] for shift, success in shift_results], dtype=float64)
+                shifts_x = asarray([shift[1] for shift, success in shift_results], dtype=float64)
+                successes = asarray([success for shift, success in shift_results], dtype=bool)
 
                 # The total shift consists of three components: different coordinate origins for
                 # current frame and mean frame, global shift of current frame, and the local warp
-                # shift at this alignment point. The first two components are accounted for by dy,
+                # shift at the alignment point. The first two components are accounted for by dy,
                 # dx. If drizzle is active, translate shifts into drizzled pixel distances.
-                shift_y_drizzled = int(round(shift_y * self.configuration.drizzle_factor))
-                shift_x_drizzled = int(round(shift_x * self.configuration.drizzle_factor))
-                total_shift_y_drizzled = dy * self.configuration.drizzle_factor - shift_y_drizzled
-                total_shift_x_drizzled = dx * self.configuration.drizzle_factor - shift_x_drizzled
-
-                # Increment the counter corresponding to the 2D warp shift. Increase the resolution
-                # according to the drizzle factor.
-                if success:
-                    self.shift_distribution[int(round(sqrt(shift_y_drizzled ** 2 + shift_x_drizzled ** 2)))] += 1
-                else:
-                    self.shift_failure_counter += 1
-
-                self.my_timer.stop('Stacking: compute AP shifts')
+                shifts_y_drizzled = rint(shifts_y * drizzle_factor).astype(int64)
+                shifts_x_drizzled = rint(shifts_x * drizzle_factor).astype(int64)
+                total_shifts_y_drizzled = dy * drizzle_factor - shifts_y_drizzled
+                total_shifts_x_drizzled = dx * drizzle_factor - shifts_x_drizzled
+
+                # Increment the counters corresponding to the 2D warp shifts of all successful shift
+                # computations. Increase the resolution according to the drizzle factor.
+                shift_radii = rint(sqrt(shifts_y_drizzled[successes] ** 2 +
+                                        shifts_x_drizzled[successes] ** 2)).astype(int64)
+                self.shift_distribution += bincount(shift_radii,
+                                                    minlength=self.shift_distribution.shape[0])
+                self.shift_failure_counter += successes.shape[0] - count_nonzero(successes)
 
                 # In debug mode: visualize shifted patch of the first AP and compare it with the
                 # corresponding patch of the reference frame.
-                if self.debug and not alignment_point_index:
-                    frame_mono_blurred = self.frames.frames_mono_blurred(frame_index)
-                    total_shift_y = dy - shift_y
-                    total_shift_y_int = int(round(total_shift_y))
-                    total_shift_x = dx - shift_x
-                    total_shift_x_int = int(round(total_shift_x))
-                    y_low = alignment_point['patch_y_low']
-                    y_high = alignment_point['patch_y_high']
-                    x_low = alignment_point['patch_x_low']
-                    x_high = alignment_point['patch_x_high']
-                    reference_patch = (self.alignment_points.mean_frame[y_low:y_high, x_low:x_high]).astype(uint16)
-                    reference_patch = resize(reference_patch, None,
-                                              fx=float(self.scale_factor),
-                                              fy=float(self.scale_factor))
-
-                    try:
-                        # Cut out the globally stabilized and the de-warped patches
-                        frame_stabilized = frame_mono_blurred[y_low+dy:y_high+dy, x_low+dx:x_high+dx]
-                        frame_stabilized = resize(frame_stabilized, None,
-                                                  fx=float(self.scale_factor),
-                                                  fy=float(self.scale_factor))
-                        font = FONT_HERSHEY_SIMPLEX
-                        fontScale = 0.5
-                        fontColor = (0, 255, 0)
-                        lineType = 1
-                        putText(frame_stabilized, 'stabilized: ' + str(dy) + ', ' + str(dx),
-                                (5, 25), font, fontScale, fontColor, lineType)
-
-                        frame_dewarped = frame_mono_blurred[y_low+total_shift_y_int:y_high+total_shift_y_int,
-                                         x_low+total_shift_x_int:x_high+total_shift_x_int]
-                        frame_dewarped = resize(frame_dewarped, None,
-                                                  fx=float(self.scale_factor),
-                                                  fy=float(self.scale_factor))
-                        putText(frame_dewarped, 'de-warped: ' + str(int(round(shift_y))) + ', ' +
-                                str(int(round(shift_x))), (5, 25), font, fontScale, fontColor, lineType)
-                        # Compose the three patches into a single image and send it to the
-                        # visualization window.
-                        composed_image = Miscellaneous.compose_image([frame_stabilized,
-                                            reference_patch, frame_dewarped],
-                                            border=self.border)
-                        self.update_image_window_signal.emit(composed_image)
-                    except Exception as e:
-                        print(str(e))
-
-                    # Insert a delay to keep the current frame long enough in the visualization
-                    # window.
-                    sleep(self.image_delay)
-
-                # Add the shifted alignment point patch to the AP's stacking buffer.
+                if debug and 0 in alignment_point_indices:
+                    shift_y, shift_x = shift_results[alignment_point_indices.index(0)][0]
+                    self.visualize_de_warp(frame_index, dy, dx, shift_y, shift_x)
+
+                self.my_timer.stop('Stacking: compute AP shifts')
+
+                # Add the shifted alignment point patches to the APs' stacking buffers.
                 self.my_timer.start('Stacking: remapping and adding')
-                self.remap_rigid(self.frame_drizzled, alignment_point['stacking_buffer'],
-                                 total_shift_y_drizzled, total_shift_x_drizzled,
-                                 alignment_point['patch_y_low_drizzled'],
-                                 alignment_point['patch_y_high_drizzled'],
-                                 alignment_point['patch_x_low_drizzled'],
-                                 alignment_point['patch_x_high_drizzled'])
+                if numba_kernels is not None:
+                    numba_kernels.remap_rigid_alignment_points(
+                        self.frame_drizzled.reshape(self.frame_drizzled.shape[0], -1),
+                        self.stacking_buffers, channels,
+                        asarray(alignment_point_indices, dtype=int64),
+                        total_shifts_y_drizzled, total_shifts_x_drizzled,
+                        self.alignment_points.patch_bounds_drizzled, borders)
+                else:
+                    for used_index, alignment_point_index in enumerate(alignment_point_indices):
+                        alignment_point = alignment_point_list[alignment_point_index]
+                        self.remap_rigid(self.frame_drizzled, alignment_point['stacking_buffer'],
+                                         total_shifts_y_drizzled[used_index],
+                                         total_shifts_x_drizzled[used_index],
+                                         alignment_point['patch_y_low_drizzled'],
+                                         alignment_point['patch_y_high_drizzled'],
+                                         alignment_point['patch_x_low_drizzled'],
+                                         alignment_point['patch_x_high_drizzled'])
                 self.my_timer.stop('Stacking: remapping and adding')
 
-            # If there are holes between AP patches, add this frame's contribution (if any) to the
-            # averaged background image.
-            if self.number_stacking_holes > 0 and \
-                    frame_index in self.rank_frames.quality_sorted_indices[
-                        :self.alignment_points.stack_size]:
-                self.my_timer.start('Stacking: computing background')
-
-                # Treat the case that the background is computed for specific patches only.
-                if self.background_patches:
-                    for patch in self.background_patches:
-                        self.averaged_background[patch['patch_y_low']:patch['patch_y_high'],
-                                  patch['patch_x_low']:patch['patch_x_high']] += \
-                            frame[patch['patch_y_low'] + dy : patch['patch_y_high'] + dy,
-                                  patch['patch_x_low'] + dx : patch['patch_x_high'] + dx]
-
-                # The complete background image is computed.
-                else:
-                    self.averaged_background += frame[dy:self.dim_y + dy, dx:self.dim_x + dx]
-                self.my_timer.stop('Stacking: computing background')
+                # If there are holes between AP patches, add this frame's contribution (if any) to
+                # the averaged background image.
+                if self.number_stacking_holes > 0 and background_frames[frame_index]:
+                    self.my_timer.start('Stacking: computing background')
+
+                    # Treat the case that the background is computed for specific patches only.
+                    if self.background_patches and numba_kernels is not None:
+                        numba_kernels.accumulate_background_patches(
+                            self.averaged_background.reshape(self.dim_y, -1),
+                            frame.reshape(frame.shape[0], -1), channels, dy, dx,
+                            self.background_patch_bounds)
+                    elif self.background_patches:
+                        for patch in self.background_patches:
+                            self.averaged_background[patch['patch_y_low']:patch['patch_y_high'],
+                                      patch['patch_x_low']:patch['patch_x_high']] += \
+                                frame[patch['patch_y_low'] + dy : patch['patch_y_high'] + dy,
+                                      patch['patch_x_low'] + dx : patch['patch_x_high'] + dx]
+
+                    # The complete background image is computed.
+                    else:
+                        self.averaged_background += frame[dy:self.dim_y + dy, dx:self.dim_x + dx]
+                    self.my_timer.stop('Stacking: computing background')
 
         if self.progress_signal is not None:
             self.progress_signal.emit("Stack frames", 100)
 
+        # Copy the border widths collected by the compiled kernels.
+        if numba_kernels is not None:
+            self.border_y_low, self.border_y_high, self.border_x_low, self.border_x_high = \
+                (int(border) for border in borders)
+
         # Compute counters for shift distribution analysis.
         shift_counter = sum(self.shift_distribution)
         self.shift_entries_total = shift_counter + self.shift_failure_counter
@@ -495,16 +588,80 @@ class StackFrames(object):
         # coordinates and normalize the buffer values.
         if self.number_stacking_holes > 0:
             self.my_timer.start('Stacking: computing background')
+            # Divide the buffer by the number of contributions. Interpolation is linear in the
+            # pixel values, so this is done before drizzling, on the smaller buffer.
+            self.averaged_background /= self.alignment_points.stack_size
             # If drizzling is active, extend the background image into drizzled coordinates.
             if self.drizzle:
                 # Be careful: OpenCV resize expects the "width" dimension first!
                 self.averaged_background = resize(self.averaged_background,
                                                   (self.dim_x_drizzled, self.dim_y_drizzled),
                                                   interpolation=INTER_CUBIC)
-            # Divide the buffer by the number of contributions.
-            self.averaged_background /= self.alignment_points.stack_size
             self.my_timer.stop('Stacking: computing background')
 
+    def visualize_de_warp(self, frame_index, dy, dx, shift_y, shift_x):
+        """
+        In debug mode: Visualize the shifted patch of the first alignment point in a frame and
+        compare it with the corresponding patch of the reference frame. The globally stabilized,
+        the reference and the de-warped patches are composed into a single image which is sent to
+        the visualization window.
+
+        :param frame_index: Index of the current frame
+        :param dy: Global shift of the frame in y direction
+        :param dx: Global shift of the frame in x direction
+        :param shift_y: Local warp shift of the first alignment point in y direction
+        :param shift_x: Local warp shift of the first alignment point in x direction
+        :return: -
+        """
+
+        alignment_point = self.alignment_points.alignment_points[0]
+        frame_mono_blurred = self.frames.frames_mono_blurred(frame_index)
+        total_shift_y = dy - shift_y
+        total_shift_y_int = int(round(total_shift_y))
+        total_shift_x = dx - shift_x
+        total_shift_x_int = int(round(total_shift_x))
+        y_low = alignment_point['patch_y_low']
+        y_high = alignment_point['patch_y_high']
+        x_low = alignment_point['patch_x_low']
+        x_high = alignment_point['patch_x_high']
+        reference_patch = (self.alignment_points.mean_frame[y_low:y_high, x_low:x_high]).astype(uint16)
+        reference_patch = resize(reference_patch, None,
+                                  fx=float(self.scale_factor),
+                                  fy=float(self.scale_factor))
+
+        try:
+            # Cut out the globally stabilized and the de-warped patches
+            frame_stabilized = frame_mono_blurred[y_low+dy:y_high+dy, x_low+dx:x_high+dx]
+            frame_stabilized = resize(frame_stabilized, None,
+                                      fx=float(self.scale_factor),
+                                      fy=float(self.scale_factor))
+            font = FONT_HERSHEY_SIMPLEX
+            fontScale = 0.5
+            fontColor = (0, 255, 0)
+            lineType = 1
+            putText(frame_stabilized, 'stabilized: ' + str(dy) + ', ' + str(dx),
+                    (5, 25), font, fontScale, fontColor, lineType)
+
+            frame_dewarped = frame_mono_blurred[y_low+total_shift_y_int:y_high+total_shift_y_int,
+                             x_low+total_shift_x_int:x_high+total_shift_x_int]
+            frame_dewarped = resize(frame_dewarped, None,
+                                      fx=float(self.scale_factor),
+                                      fy=float(self.scale_factor))
+            putText(frame_dewarped, 'de-warped: ' + str(int(round(shift_y))) + ', ' +
+                    str(int(round(shift_x))), (5, 25), font, fontScale, fontColor, lineType)
+            # Compose the three patches into a single image and send it to the
+            # visualization window.
+            composed_image = Miscellaneous.compose_image([frame_stabilized,
+                                reference_patch, frame_dewarped],
+                                border=self.border)
+            self.update_image_window_signal.emit(composed_image)
+        except Exception as e:
+            print(str(e))
+
+        # Insert a delay to keep the current frame long enough in the visualization
+        # window.
+        sleep(self.image_delay)
+
     def remap_rigid(self, frame, buffer, shift_y, shift_x, y_low, y_high, x_low, x_high):
         """
         The alignment point patch is taken from the given frame with a constant shift in x and y
@@ -521,6 +678,20 @@ class StackFrames(object):
         :return: -
         """
 
+        # If available, use the compiled kernel. It works on 2D views with color channels merged
+        # into the x dimension. This requires a C-contiguous buffer, so that the view shares its
+        # memory.
+        if numba_kernels is not None and buffer.flags.c_contiguous:
+            channels = buffer.shape[2] if buffer.ndim == 3 else 1
+            borders = asarray([self.border_y_low, self.border_y_high, self.border_x_low,
+                               self.border_x_high], dtype=int64)
+            numba_kernels.remap_rigid(frame.reshape(frame.shape[0], -1),
+                                      buffer.reshape(buffer.shape[0], -1), channels, shift_y,
+                                      shift_x, y_low, y_high, x_low, x_high, borders)
+            self.border_y_low, self.border_y_high, self.border_x_low, self.border_x_high = \
+                (int(border) for border in borders)
+            return
+
         # Compute index bounds for "source" patch in current frame, and for summation buffer
         # ("target"). Because of local warp effects, the indexing may reach beyond frame borders.
         # In this case reduce the copy area.
@@ -570,79 +741,230 @@ class StackFrames(object):
 
         self.my_timer.start('Stacking: merging AP buffers')
 
-        # Add the contributions of all alignment points into a single buffer.
-        for alignment_point in self.alignment_points.alignment_points:
-            patch_y_low_drizzled = alignment_point['patch_y_low_drizzled']
-            patch_y_high_drizzled = alignment_point['patch_y_high_drizzled']
-            patch_x_low_drizzled = alignment_point['patch_x_low_drizzled']
-            patch_x_high_drizzled = alignment_point['patch_x_high_drizzled']
-
-            # Add the stacking buffer of the alignment point to the appropriate location of the
-            # global stacking buffer.
-            if self.frames.color:
-                self.stacked_image_buffer[patch_y_low_drizzled:patch_y_high_drizzled,
-                patch_x_low_drizzled: patch_x_high_drizzled, :] += \
-                    alignment_point['stacking_buffer'] * alignment_point['weights_yx'][:, :, newaxis]
-            else:
-                self.stacked_image_buffer[patch_y_low_drizzled:patch_y_high_drizzled,
-                patch_x_low_drizzled: patch_x_high_drizzled] += alignment_point['stacking_buffer'] * \
-                                              alignment_point['weights_yx']
+        # All buffers used in merging are single precision (this halves the memory traffic
+        # compared to float64). The compiled kernels rely on this, so check it here.
+        for buffer in (self.stacked_image_buffer, self.sum_single_frame_weights,
+                       self.averaged_background, self.alignment_points.stacking_buffers_slab):
+            if buffer is not None and buffer.dtype != float32:
+                raise InternalError("Stacking buffer with type " + str(buffer.dtype) +
+                                    " instead of float32")
+
+        # Add the contributions of all alignment points into a single buffer. The AP patches are
+        # processed tile by tile (tiles of 256x256 drizzled pixels, ordered row by row), so that
+        # the writes into the global buffer stay local, even if the AP list is not ordered
+        # geometrically (e.g. after manual editing).
+        #
+        # Overlapping patches must not be added concurrently. Therefore, the APs are partitioned
+        # into classes of pairwise disjoint patches. The classes are merged one after the other,
+        # the APs within a class in parallel threads. The summation order at each pixel only
+        # depends on the classes, so the result does not depend on the number of threads.
+        patch_bounds = self.alignment_points.patch_bounds_drizzled
+        merge_order = lexsort((patch_bounds[:, 2] // 256, patch_bounds[:, 0] // 256))
+        merge_classes = self.disjoint_patch_classes(patch_bounds, merge_order)
+        number_workers = cpu_count() or 1
+
+        # If available, a compiled kernel adds the weighted AP stacking buffers. Each thread calls
+        # it for a chunk of the APs in a class.
+        if numba_kernels is not None and self.patch_weights_y is not None:
+            merge_chunk = partial(numba_kernels.merge_alignment_point_buffers,
+                                  self.stacked_image_buffer.reshape(self.dim_y_drizzled, -1),
+                                  self.stacking_buffers, 3 if self.frames.color else 1,
+                                  self.patch_weights_y, self.patch_weights_x, patch_bounds)
+        else:
+            merge_chunk = self.merge_alignment_point_chunk
+
+        # With a single worker the classes are merged in this thread, in the same order.
+        if number_workers > 1:
+            with ThreadPoolExecutor(max_workers=number_workers) as executor:
+                for merge_class in merge_classes:
+                    list(executor.map(merge_chunk, array_split(
+                        merge_class, min(number_workers, len(merge_class)))))
+        else:
+            for merge_class in merge_classes:
+                merge_chunk(merge_class)
 
-        # Divide the global stacking buffer pixel-wise by the number of image contributions. Please
-        # note that there is no division by zero because the array "sum_single_frame_weights" was
-        # initialized to 1.E-30.
+        # Divide the global stacking buffer pixel-wise by the number of image contributions, blend
+        # it with the background image (if there are holes between AP patches), and scale it to
+        # the interval [0., 1.]. Please note that there is no division by zero (in the reciprocal)
+        # because the array "sum_single_frame_weights" was initialized to 1.E-30.
+        #
+        # If available, a compiled kernel does all this in a single pass, together with trimming
+        # the borders and the conversion to 16bit int (see below). It writes the final image
+        # directly.
+        if numba_kernels is not None:
+            dim_y_image = self.dim_y_drizzled - self.border_y_low - self.border_y_high
+            dim_x_image = self.dim_x_drizzled - self.border_x_low - self.border_x_high
+            self.stacked_image = empty((dim_y_image, dim_x_image) +
+                                       self.stacked_image_buffer.shape[2:], dtype=uint16)
+            blend = self.number_stacking_holes > 0
+            numba_kernels.finalize_stacked_image(
+                self.stacked_image_buffer.reshape(self.dim_y_drizzled, -1),
+                self.sum_single_frame_weights,
+                (self.averaged_background if blend else self.stacked_image_buffer).reshape(
+                    self.dim_y_drizzled, -1), 3 if self.frames.color else 1,
+                float32(self.configuration.stack_frames_background_blend_threshold *
+                        self.alignment_points.stack_size),
+                float32(255 if self.frames.depth == 8 else 65535), blend, self.border_y_low,
+                self.border_x_low, self.stacked_image.reshape(dim_y_image, -1))
+            self.my_timer.stop('Stacking: merging AP buffers')
+            return self.stacked_image
+
+        # Multiply with the reciprocal weights, computed once per pixel (not per color
+        # channel). This is cheaper than a division. If numexpr is available (but numba is not),
+        # it evaluates this and the following pixel-wise expressions in a single multi-threaded
+        # pass over the buffer, without temporaries.
+        weights_reciprocal = reciprocal(self.sum_single_frame_weights)
         if self.frames.color:
-            self.stacked_image_buffer /= self.sum_single_frame_weights[:, :, newaxis]
+            weights_reciprocal = weights_reciprocal[:, :, newaxis]
+        if numexpr is not None:
+            numexpr.evaluate("buffer * weights_reciprocal",
+                             local_dict={'buffer': self.stacked_image_buffer,
+                                         'weights_reciprocal': weights_reciprocal},
+                             out=self.stacked_image_buffer)
         else:
-            self.stacked_image_buffer /= self.sum_single_frame_weights
+            self.stacked_image_buffer *= weights_reciprocal
 
         self.my_timer.stop('Stacking: merging AP buffers')
 
         # If the alignment points do not cover the full frame, blend the AP contributions with
-        # a background computed as the average of globally shifted best frames. The background
-        # should only shine through outside AP patches.
+        # a background computed as the average of globally shifted best frames. The
+        # background should only shine through outside AP patches.
         if self.number_stacking_holes > 0:
             self.my_timer.create_no_check('Stacking: blending APs with background')
 
-            # The background image has been computed where self.sum_single_frame_weights is below the
-            # threshold. Compute for every pixel the weight (between 0. and 1.) with which the
-            # stacked patches are to be blended with the background image. Please note that the
-            # weights have to be divided by the stack size first, to normalize them to 1. at patch
-            # centers.
+            # The background image has been computed where self.sum_single_frame_weights is
+            # below the threshold. Compute for every pixel the weight (between 0. and 1.) with
+            # which the stacked patches are to be blended with the background image. Please
+            # note that the weights have to be divided by the stack size first, to normalize
+            # them to 1. at patch centers.
             foreground_weight = self.sum_single_frame_weights / \
-                                     (self.configuration.stack_frames_background_blend_threshold *
-                                      self.alignment_points.stack_size)
+                                (self.configuration.stack_frames_background_blend_threshold *
+                                 self.alignment_points.stack_size)
             clip(foreground_weight, 0., 1., out=foreground_weight)
 
-            # Blend the AP buffer with the background.
+            # Blend the AP buffer with the background. Do it in place to avoid full-size
+            # temporaries, and only where the foreground weight is below 1. (elsewhere the
+            # background does not contribute).
+            blend_mask = foreground_weight < 1.
             if self.frames.color:
-                self.stacked_image_buffer = (self.stacked_image_buffer-self.averaged_background) * \
-                                            foreground_weight[:, :, newaxis] + \
-                                            self.averaged_background
+                foreground_weight = foreground_weight[:, :, newaxis]
+                blend_mask = blend_mask[:, :, newaxis]
+            if numexpr is not None:
+                numexpr.evaluate("where(blend_mask, (buffer - background) * foreground_weight + "
+                                 "background, buffer)",
+                                 local_dict={'blend_mask': blend_mask,
+                                             'buffer': self.stacked_image_buffer,
+                                             'background': self.averaged_background,
+                                             'foreground_weight': foreground_weight},
+                                 out=self.stacked_image_buffer)
             else:
-                self.stacked_image_buffer = (self.stacked_image_buffer-self.averaged_background) * \
-                                            foreground_weight + self.averaged_background
+                subtract(self.stacked_image_buffer, self.averaged_background,
+                         out=self.stacked_image_buffer, where=blend_mask)
+                multiply(self.stacked_image_buffer, foreground_weight,
+                         out=self.stacked_image_buffer, where=blend_mask)
+                add(self.stacked_image_buffer, self.averaged_background,
+                    out=self.stacked_image_buffer, where=blend_mask)
 
             self.my_timer.stop('Stacking: blending APs with background')
 
         # Trim the borders of the stacked buffer such that no artifacts from incomplete stacks
-        # (caused by warp shifts) remain.
-        if self.border_y_low or self.border_y_high or self.border_x_low or self.border_x_high:
-            self.stacked_image_buffer = self.stacked_image_buffer[
-                                        self.border_y_low:self.dim_y_drizzled - self.border_y_high,
-                                        self.border_x_low:self.dim_x_drizzled - self.border_x_high]
-
-        # Scale the image buffer such that entries are in the interval [0., 1.]. Then convert the
-        # float image buffer to 16bit int (or 48bit in color mode).
-        if self.frames.depth == 8:
-            self.stacked_image = img_as_uint(
-                clip(self.stacked_image_buffer / 255, 0., 1., out=self.stacked_image_buffer))
-        else:
-            self.stacked_image = img_as_uint(
-                clip(self.stacked_image_buffer / 65535, 0., 1., out=self.stacked_image_buffer))
+        # (caused by warp shifts) remain, and scale the image buffer such that entries are in the
+        # interval [0., 1.]. The division writes into a new buffer of the trimmed size, so that the
+        # full-size buffer is released (a trimmed view would keep it alive).
+        self.stacked_image_buffer = true_divide(
+            self.stacked_image_buffer[self.border_y_low:self.dim_y_drizzled - self.border_y_high,
+                                      self.border_x_low:self.dim_x_drizzled - self.border_x_high],
+            float32(255 if self.frames.depth == 8 else 65535))
+        clip(self.stacked_image_buffer, 0., 1., out=self.stacked_image_buffer)
+
+        # Convert the float image buffer to 16bit int (or 48bit in color mode). Do it in place and
+        # write into a preallocated image, with the same rounding as in "img_as_uint".
+        multiply(self.stacked_image_buffer, float32(65535.), out=self.stacked_image_buffer)
+        rint(self.stacked_image_buffer, out=self.stacked_image_buffer)
+        self.stacked_image = empty(self.stacked_image_buffer.shape, dtype=uint16)
+        copyto(self.stacked_image, self.stacked_image_buffer, casting='unsafe')
 
         return self.stacked_image
 
+    def merge_alignment_point_chunk(self, alignment_point_indices):
+        """
+        Add the stacking buffers of some alignment points, multiplied with their blending weights,
+        to the global stacking buffer. This is the numpy version of the compiled kernel
+        "numba_kernels.merge_alignment_point_buffers".
+
+        :param alignment_point_indices: Array with the indices of the alignment points
+        :return: -
+        """
+
+        # The weighted AP buffers are computed in a scratch buffer, large enough for the largest
+        # patch of this chunk. The AP stacking buffers themselves are left unchanged, as in the
+        # compiled kernel.
+        patch_bounds = self.alignment_points.patch_bounds_drizzled[alignment_point_indices]
+        scratch_buffer = empty(
+            ((patch_bounds[:, 1] - patch_bounds[:, 0]).max(),
+             (patch_bounds[:, 3] - patch_bounds[:, 2]).max()) + self.stacked_image_buffer.shape[2:],
+            dtype=float32)
+
+        for alignment_point_index in alignment_point_indices:
+            alignment_point = self.alignment_points.alignment_points[alignment_point_index]
+            stacking_buffer = alignment_point['stacking_buffer']
+            weighted_buffer = scratch_buffer[:stacking_buffer.shape[0], :stacking_buffer.shape[1]]
+
+            # Expand the 2D blending weights of the alignment point from the one-dimensional
+            # weights (see "prepare_for_stack_blending").
+            weights_yx = minimum(alignment_point['weights_y'][:, newaxis],
+                                 alignment_point['weights_x'][newaxis, :])
+
+            # Apply the weights to the stacking buffer of the alignment point. Then add it to the
+            # appropriate location of the global stacking buffer.
+            if self.frames.color:
+                multiply(stacking_buffer, weights_yx[:, :, newaxis], out=weighted_buffer)
+            else:
+                multiply(stacking_buffer, weights_yx, out=weighted_buffer)
+            self.stacked_image_buffer[
+            alignment_point['patch_y_low_drizzled']:alignment_point['patch_y_high_drizzled'],
+            alignment_point['patch_x_low_drizzled']:alignment_point['patch_x_high_drizzled']] += \
+                weighted_buffer
+
+    @staticmethod
+    def disjoint_patch_classes(patch_bounds, order):
+        """
+        Partition the alignment point patches into classes of pairwise disjoint patches. The
+        patches of a class can be merged concurrently.
+
+        :param patch_bounds: Integer array of shape [number of alignment points, 4] with the
+                             patch bounds y_low, y_high, x_low, x_high of all alignment points
+        :param order: Integer array with the AP indices in the order in which they are assigned
+        :return: List of integer arrays with the AP indices of the classes. Within a class, the
+                 indices are in the given order.
+        """
+
+        number_alignment_points = len(order)
+        if not number_alignment_points:
+            return []
+        bounds = patch_bounds[order]
+
+        # Sort the patches into the cells of a grid. The cells are at least as large as the
+        # largest patch. Therefore, patches can only overlap if their lower corners are in the same
+        # or in neighboring cells.
+        cell_y = bounds[:, 0] // max((bounds[:, 1] - bounds[:, 0]).max(), 1)
+        cell_x = bounds[:, 2] // max((bounds[:, 3] - bounds[:, 2]).max(), 1)
+        cell = cell_y * (cell_x.max() + 1) + cell_x
+
+        # Number the patches within each cell, in the given order.
+        cell_order = argsort(cell, kind='stable')
+        cell_sorted = cell[cell_order]
+        cell_starts = flatnonzero(concatenate(([True], cell_sorted[1:] != cell_sorted[:-1])))
+        index_in_cell = empty(number_alignment_points, dtype=int64)
+        index_in_cell[cell_order] = arange(number_alignment_points) - repeat(
+            cell_starts, diff(concatenate((cell_starts, [number_alignment_points]))))
+
+        # Patches with the same index within their cells, and in cells with the same parity in
+        # both coordinate directions, are pairwise disjoint. They form a class.
+        patch_class = 4 * index_in_cell + 2 * (cell_y % 2) + cell_x % 2
+        class_order = argsort(patch_class, kind='stable')
+        return split(order[class_order], flatnonzero(diff(patch_class[class_order])) + 1)
+
     def half_stacked_image_buffer_resolution(self):
         """
         If drizzling is active with the option 1.5x, the computations are performed with the factor
@@ -672,9 +994,26 @@ class StackFrames(object):
                  1./(patch_high - box_center) at patch_high-1.
         """
 
-        # Compute offsets relative to patch_low.
-        patch_high_offset = patch_high - patch_low
-        center_offset = box_center - patch_low
+        # Compute offsets relative to patch_low. The weights only depend on these offsets and the
+        # "extend" flags. The few different combinations are computed only once.
+        return StackFrames.one_dim_weight_offsets(patch_high - patch_low, box_center - patch_low,
+                                                  extend_low, extend_high)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def one_dim_weight_offsets(patch_high_offset, center_offset, extend_low, extend_high):
+        """
+        Compute one-dimensional weighting ramps for a patch starting at index 0 (see method
+        "one_dim_weight"). Results are cached. They are returned as read-only arrays, because the
+        same array is shared by all patches with the same geometry.
+
+        :param patch_high_offset: Patch size in the given coordinate direction
+        :param center_offset: Offset of the AP coordinate index from the lower patch index
+        :param extend_low: If true, set all weights below center_offset to 1.
+        :param extend_high: If true, set all weights from center_offset to patch_high_offset-1
+                            to 1.
+        :return: Vector (read-only) with weights
+        """
 
         # Allocate weights array, length given by patch size.
         weights = empty((patch_high_offset,), dtype=float32)
@@ -682,10 +1021,11 @@ class StackFrames(object):
         # If extend_low: Replace lower ramp with constant value 1.
         if extend_low:
             weights[0:center_offset] = 1.
-        # Ramp up from a small value to 1. at the center coordinate.
+        # Ramp up from a small value to 1. at the center coordinate. The ramp is computed in
+        # double precision and rounded when stored into the weights array.
         else:
-            weights[0:center_offset] = arange(1, center_offset + 1, 1) / float32(
-                center_offset + 1)
+            true_divide(arange(1, center_offset + 1, 1), float32(center_offset + 1),
+                        out=weights[0:center_offset])
 
         # Now set the weights for indices starting with the center coordinate (weight 1.) and
         # ending at the upper patch boundary with a small value. Again, if "extend_high" is set
@@ -693,10 +1033,11 @@ class StackFrames(object):
         if extend_high:
             weights[center_offset:patch_high_offset] = 1.
         else:
-            weights[center_offset:patch_high_offset] = arange(patch_high - box_center, 0,
-                                                                 -1) / float32(
-                patch_high - box_center)
+            true_divide(arange(patch_high_offset - center_offset, 0, -1),
+                        float32(patch_high_offset - center_offset),
+                        out=weights[center_offset:patch_high_offset])
 
+        weights.setflags(write=False)
         return weights
 
     def print_shift_table(self):
@@ -708,20 +1049,17 @@ class StackFrames(object):
         """
 
         # Find the last non-zero entry in the array.
-        if max(self.shift_distribution) > 0:
-            max_index = [index for index, item in enumerate(self.shift_distribution) if item != 0][-1] \
-                        + 1
-
-            # Initialize the three table lines.
-            s =    "           Shift (pixels):"
-            line = "           ---------------"
-            t =    "           Percent:       "
-
-            # Extend the three table lines up to the max index.
-            for index in range(max_index):
-                s += "|{:7d} ".format(index)
-                line += "---------"
-                t += "|{:7.3f} ".format(100.*self.shift_distribution[index]/self.shift_entries_total)
+        non_zero_indices = flatnonzero(self.shift_distribution)
+        if non_zero_indices.shape[0]:
+            max_index = int(non_zero_indices[-1]) + 1
+
+            # Initialize the three table lines, and extend them up to the max index.
+            percents = 100. * self.shift_distribution[:max_index] / self.shift_entries_total
+            s =    "           Shift (pixels):" + "".join(
+                "|{:7d} ".format(index) for index in range(max_index))
+            line = "           ---------------" + "---------" * max_index
+            t =    "           Percent:       " + "".join(
+                "|{:7.3f} ".format(percent) for percent in percents)
 
             # Finish the three table lines.
             s += "|"